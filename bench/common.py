@@ -0,0 +1,41 @@
+'''
+Shared setup for the benchmark scripts in this directory. Each script is
+run on its own, from the top of the tree:
+
+    python bench/serialize_plan.py
+
+Django is configured with an in memory database unless
+DJANGO_SETTINGS_MODULE is set.
+'''
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from django.conf import settings
+
+if not 'DJANGO_SETTINGS_MODULE' in os.environ and not settings.configured:
+    settings.configure(
+        DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+        INSTALLED_APPS = ['django.contrib.contenttypes', 'django.contrib.auth'],
+        USE_TZ = True,
+    )
+
+
+def bench(label, func, number = 10000, repeat = 3, baseline = None):
+    '''
+    Times func (best of repeat runs of number calls) and prints the cost
+    per call. If baseline (a previous result of bench) is given, the
+    speedup over it is printed too. Returns the cost per call, in seconds.
+    '''
+
+    per_call = min(timeit.repeat(func, number = number, repeat = repeat)) / number
+
+    line = '%-40s %10.2f us/call' % (label, per_call * 1e6)
+    if baseline:
+        line += '  (%.1fx)' % (baseline / per_call)
+    print(line)
+
+    return per_call
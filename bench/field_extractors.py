@@ -0,0 +1,83 @@
+'''
+Cost of reading api_fields with the compiled field extractors of
+api_serialize, against django's python serializer (which api_serialize
+used to run on every object), on a model with 10 auto fields.
+
+    python bench/field_extractors.py
+'''
+
+import common
+
+from datetime import datetime
+from decimal import Decimal
+
+from django.core import serializers
+from django.db import models
+from django.utils import timezone
+
+from locast.api import api_serialize
+
+
+class Author(models.Model):
+    class Meta:
+        app_label = 'bench'
+
+    name = models.CharField(max_length=50)
+
+
+class Track(models.Model):
+    class Meta:
+        app_label = 'bench'
+
+    api_fields = ('title', 'slug', 'description', 'author', 'created', 'duration',
+            'length', 'rating', 'public', 'path')
+
+    title = models.CharField(max_length=160)
+    slug = models.SlugField()
+    description = models.TextField()
+    author = models.ForeignKey(Author)
+    created = models.DateTimeField()
+    duration = models.IntegerField()
+    length = models.FloatField()
+    rating = models.DecimalField(max_digits=4, decimal_places=2)
+    public = models.BooleanField()
+    path = models.CharField(max_length=255)
+
+    # Not in api_fields
+    secret = models.CharField(max_length=50)
+
+
+def api_fields_serialized(obj):
+    ''' How api_serialize read api_fields before the field extractors. '''
+
+    fields_dict = {}
+    for s in serializers.serialize('python', [obj], fields=obj.api_fields):
+        fields_dict = s['fields']
+        fields_dict['id'] = s['pk']
+
+    return fields_dict
+
+
+def main():
+    objs = [Track(id = i, title = u'Track %d' % i, slug = u'track-%d' % i,
+            description = u'A walk around the block. ' * 5, author_id = i % 7,
+            created = datetime(2013, 1, 1, tzinfo=timezone.utc), duration = 60 * i,
+            length = 1.5 * i, rating = Decimal('3.50'), public = True,
+            path = u'/media/tracks/%d.gpx' % i, secret = u'x') for i in range(100)]
+
+    assert [api_serialize(o) for o in objs] == [api_fields_serialized(o) for o in objs]
+
+    def serialized():
+        for o in objs:
+            api_fields_serialized(o)
+
+    def extracted():
+        for o in objs:
+            api_serialize(o)
+
+    base = common.bench('serializers.serialize (per 100 objects)', serialized, number = 200)
+    common.bench('field extractors (per 100 objects)', extracted, number = 200, baseline = base)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+'''
+Encode and decode throughput of the API JSON codecs (see locast.api.codec)
+on a page of serialized casts, with dates, Decimals and points left for the
+codec to encode.
+
+    python bench/json_codec.py [dotted.path.to.Codec ...]
+
+The json and simplejson codecs are always timed (simplejson only if it is
+installed). Any other codec classes can be named on the command line.
+'''
+
+import common
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+import sys
+
+from django.contrib.gis.geos import Point
+from django.utils import timezone
+from django.utils.importlib import import_module
+
+from locast.api import codec
+
+
+def payload(count = 100):
+    ''' A list of count dictionaries, like the ones api_serialize makes. '''
+
+    created = datetime(2013, 1, 1, tzinfo=timezone.utc)
+
+    objs = []
+    for i in range(count):
+        objs.append({
+            'id': i,
+            'uri': '/api/cast/%d/' % i,
+            'url': '/casts/%d/' % i,
+            'uuid': 'b7e0b4a2-5d4a-4f1e-9b1e-%012d' % i,
+            'created': created + timedelta(minutes=i),
+            'modified': created + timedelta(hours=i),
+            'title': u'Cast n\xfamero %d' % i,
+            'description': u'Some text about the cast, long enough to be realistic. ' * 4,
+            'author': {'id': i % 7, 'display_name': u'User %d' % (i % 7), 'uri': '/api/user/%d/' % (i % 7)},
+            'is_author': False,
+            'allowed_edit': False,
+            'privacy': 1,
+            'location': Point(-71.09 + i * 1e-4, 42.36 - i * 1e-4),
+            'rating': Decimal('4.25'),
+            'favorite': i % 3 == 0,
+            'favorite_count': i % 11,
+            'tags': ['tag%d' % (i % 5), 'tag%d' % (i % 13)],
+            'system_tags': [],
+        })
+
+    return objs
+
+
+def codecs(names):
+    found = [('json', codec.JSONCodec())]
+
+    try:
+        found.append(('simplejson', codec.SimpleJSONCodec()))
+    except ImportError:
+        print('simplejson is not installed')
+
+    for name in names:
+        module, cls = name.rsplit('.', 1)
+        found.append((name, getattr(import_module(module), cls)()))
+
+    return found
+
+
+def main():
+    objs = payload()
+
+    for name, c in codecs(sys.argv[1:]):
+        encoded = c.dumps(objs)
+        assert c.loads(encoded) == codec.JSONCodec().loads(encoded)
+
+        size = len(encoded) / 1e6
+        per_call = common.bench('%s dumps (100 objects)' % name, lambda: c.dumps(objs), number = 200)
+        print('%-40s %10.2f MB/s' % ('', size / per_call))
+
+        per_call = common.bench('%s loads (100 objects)' % name, lambda: c.loads(encoded), number = 200)
+        print('%-40s %10.2f MB/s' % ('', size / per_call))
+
+
+if __name__ == '__main__':
+    main()
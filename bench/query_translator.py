@@ -0,0 +1,85 @@
+'''
+Throughput of QueryTranslator.filter with a compiled ruleset, on query
+strings like the ones the cast list endpoints get. The QuerySets are built
+but not run.
+
+    python bench/query_translator.py
+'''
+
+import common
+
+from django.contrib.auth.models import User
+from django.db import models
+from django.http import QueryDict
+
+from locast.api.qstranslate import QueryTranslator, compile_ruleset
+
+
+class Tag(models.Model):
+    class Meta:
+        app_label = 'bench'
+
+    name = models.CharField(max_length=100, primary_key=True)
+
+
+class Cast(models.Model):
+    class Meta:
+        app_label = 'bench'
+
+    title = models.CharField(max_length=160)
+    description = models.TextField()
+    author = models.ForeignKey(User)
+    created = models.DateTimeField()
+    modified = models.DateTimeField()
+    privacy = models.IntegerField()
+    official = models.BooleanField()
+    tags = models.ManyToManyField(Tag)
+
+
+ruleset = {
+    'author'        :    { 'type' : 'string', 'alias' : 'author__username' },
+    'title'         :    { 'type' : 'string' },
+    'description'   :    { 'type' : 'string' },
+    'created'       :    { 'type' : 'datetime' },
+    'modified'      :    { 'type' : 'datetime' },
+    'privacy'       :    { 'type' : 'int' },
+    'official'      :    { 'type' : 'bool' },
+    'tags'          :    { 'type' : 'list' },
+}
+
+QUERIES = [
+    'page=2&pagesize=20',
+    'author=someone&orderby=-modified',
+    'title__icontains=walk&privacy__lte=2&pagesize=50',
+    'tags=art,music&orderby=-created,title',
+    'tags__any=art,music,~noise&official=true',
+    'modified__gt=2013-01-01T00:00:00Z&author__iexact=Someone&page=3&pagesize=20',
+    'description__contains=river&created__lt=2013-06-01T00:00:00Z&fields=id,title,author',
+]
+
+
+def main():
+    qdicts = [QueryDict(q) for q in QUERIES]
+    translator = QueryTranslator(Cast, ruleset)
+
+    def compiled_params():
+        compiled = compile_ruleset(ruleset)
+        for qdict in qdicts:
+            for key in qdict.keys():
+                param = compiled.param(key)
+                if param:
+                    param[0].coerce(qdict.get(key))
+
+    def filters():
+        for qdict in qdicts:
+            translator.filter(qdict)
+
+    per_call = common.bench('parameters parsed (%d queries)' % len(qdicts), compiled_params, number = 2000)
+    print('%-40s %10.0f queries/s' % ('', len(qdicts) / per_call))
+
+    per_call = common.bench('filter (%d queries)' % len(qdicts), filters, number = 200)
+    print('%-40s %10.0f queries/s' % ('', len(qdicts) / per_call))
+
+
+if __name__ == '__main__':
+    main()
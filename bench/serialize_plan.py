@@ -0,0 +1,180 @@
+'''
+Per object cost of api_serialize with compiled serialization plans
+(SerializePlan), against the old path which walked the class' bases and
+probed for each hook on every call.
+
+    python bench/serialize_plan.py
+
+The hooks of the model return prebuilt values, so what is timed is the
+work api_serialize does around them.
+'''
+
+import common
+
+from django.db import models
+
+from locast.api import api_serialize, clear_serialize_plans
+
+SYNCABLE = dict(created = '2013-01-01T00:00:00Z', modified = '2013-01-02T00:00:00Z', uuid = 'b7e0b4a2')
+AUTHORABLE = dict(author = dict(id = 1, display_name = 'someone'), is_author = False)
+TITLED = dict(title = 'A cast', description = 'About it')
+LOCATABLE = dict(location = [-71.09, 42.36])
+FAVORITABLE = dict(favorites = 3)
+CAST = dict(preview_image = None)
+URL = '/casts/1/'
+URI = '/api/cast/1/'
+
+
+class Syncable(models.Model):
+    class Meta:
+        abstract = True
+        app_label = 'bench'
+
+    uuid = models.CharField(max_length=36)
+
+    def _api_serialize(self, request):
+        return SYNCABLE
+
+
+class Authorable(models.Model):
+    class Meta:
+        abstract = True
+        app_label = 'bench'
+
+    def _api_serialize(self, request):
+        return AUTHORABLE
+
+
+class Titled(models.Model):
+    class Meta:
+        abstract = True
+        app_label = 'bench'
+
+    title = models.CharField(max_length=160)
+    description = models.TextField()
+
+    def _api_serialize(self, request):
+        return TITLED
+
+
+class Locatable(models.Model):
+    class Meta:
+        abstract = True
+        app_label = 'bench'
+
+    def _api_serialize(self, request):
+        return LOCATABLE
+
+
+class Favoritable(models.Model):
+    class Meta:
+        abstract = True
+        app_label = 'bench'
+
+    def _api_serialize(self, request):
+        return FAVORITABLE
+
+
+# Interfaces without an _api_serialize, which the old path probed twice
+class ModelBase(models.Model):
+    class Meta:
+        abstract = True
+        app_label = 'bench'
+
+
+class Flaggable(models.Model):
+    class Meta:
+        abstract = True
+        app_label = 'bench'
+
+
+class Commentable(models.Model):
+    class Meta:
+        abstract = True
+        app_label = 'bench'
+
+
+class Cast(ModelBase, Syncable, Authorable, Titled, Locatable, Favoritable, Flaggable, Commentable):
+    class Meta:
+        app_label = 'bench'
+
+    def api_serialize(self, request):
+        return CAST
+
+    def get_absolute_url(self):
+        return URL
+
+    def get_api_uri(self):
+        return URI
+
+
+def api_serialize_unplanned(obj, request = None):
+    ''' api_serialize as it was before SerializePlan (without api_fields). '''
+
+    bases = obj.__class__.__bases__
+    parent_ser_dict = {}
+    model_ser_dict = {}
+    fields_dict = {}
+
+    if hasattr(obj, 'api_serialize'):
+        model_ser_dict = obj.api_serialize(request)
+        if model_ser_dict == None:
+            raise Exception('api_serialize returned no dictionary')
+
+    # This benchmark's model has no auto fields, see bench/field_extractors.py
+    hasattr(obj, 'api_fields')
+
+    if hasattr(obj, 'id'):
+        parent_ser_dict['id'] = obj.id
+
+    for cls in bases:
+        if hasattr(cls, '_api_serialize'):
+            d = cls._api_serialize(obj, request)
+            if d == None:
+                raise Exception(str(cls) + ' _api_serialize returned no dictionary')
+
+            parent_ser_dict.update(d)
+
+        else:
+            hasattr(cls, '_api_fields')
+
+    if hasattr(obj, 'get_absolute_url'):
+        abs_url = obj.get_absolute_url()
+        if abs_url:
+            parent_ser_dict['url'] = abs_url
+
+    if hasattr(obj, 'get_api_uri'):
+        parent_ser_dict['uri'] = obj.get_api_uri()
+
+    fields_dict.update(parent_ser_dict)
+    fields_dict.update(model_ser_dict)
+    return fields_dict
+
+
+def main():
+    objs = [Cast(id = i, uuid = 'b7e0b4a2-5d4a-4f1e-9b1e-%012d' % i,
+            title = 'Cast %d' % i, description = 'A cast') for i in range(100)]
+
+    assert [api_serialize(o) for o in objs] == [api_serialize_unplanned(o) for o in objs]
+
+    def unplanned():
+        for o in objs:
+            api_serialize_unplanned(o)
+
+    def cold():
+        for o in objs:
+            clear_serialize_plans()
+            api_serialize(o)
+
+    def planned():
+        for o in objs:
+            api_serialize(o)
+
+    # Costs are for 100 objects
+    base = common.bench('unplanned (per 100 objects)', unplanned, number = 300, repeat = 10)
+    common.bench('plan rebuilt per object', cold, number = 200, baseline = base)
+    common.bench('planned (per 100 objects)', planned, number = 300, repeat = 10, baseline = base)
+
+
+if __name__ == '__main__':
+    main()
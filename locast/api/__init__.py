@@ -1,18 +1,30 @@
 from datetime import datetime
-import json
-
+from itertools import islice
+import base64
+import binascii
+import hashlib
+import operator
+import re
+
+from django.conf import settings
 from django.contrib.gis.geos import Polygon
-from django.core import serializers
-from django.core.paginator import Paginator, EmptyPage
-from django.db.models import Q
-from django.http import HttpResponse, QueryDict
-
-from locast.api import exceptions
+from django.core.exceptions import ValidationError
+from django.db import connections
+from django.db.models import Field, Q
+from django.db.models.query import QuerySet, ValuesQuerySet
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.http import HttpResponse, QueryDict, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.encoding import is_protected_type, smart_text
+
+from locast.api import codec, exceptions
+from locast.api.cache import get_cache, set_cache, get_many_cache, set_many_cache
+from locast.api.profile import start_timer, stop_timer
 
 DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 
 # Content should be a python object of json serializable types
-def APIResponseOK(content=None, pg = 1, total = None):
+def APIResponseOK(content=None, pg = 1, total = None, cursor = None):
     '''
     An API friendly wrapper for a 200 HttpResponse object, used to return
     a collection of objects in json format
@@ -27,19 +39,100 @@ def APIResponseOK(content=None, pg = 1, total = None):
 
         total
             (optional) total number of objects, if this is part of a paginated
-            collection
+            collection. Left out of the headers if None.
+
+        cursor
+            (optional) the cursor of the next page, if this is part of a
+            collection paginated with paginate_cursor
     '''
 
-    content = json.dumps(content)
+    start_timer('encoding')
+    content = codec.dumps(content)
+    stop_timer('encoding')
+
     resp = HttpResponse(status=200, mimetype='application/json; charset=utf-8', content=content)
 
-    if total:
+    if total is not None:
+        resp.__setitem__('X-Object-Total', str(total))
+        resp.__setitem__('X-Page-Number', str(pg))
+
+    if cursor:
+        resp.__setitem__('X-Next-Cursor', cursor)
+
+    return resp
+
+
+def APIResponseStream(objs, request = None, pg = 1, total = None, chunk_size = 100):
+    '''
+    A streaming version of APIResponseOK, for collections too large to hold
+    in memory as a single json string. Objects are serialized (using
+    api_serialize_many) and encoded chunk_size at a time while the response
+    is being sent.
+
+    Arguments:
+
+        objs
+            A QuerySet, or an iterable of model instances or json 
+            serializable dictionaries.
+
+        request
+            Django http request object, passed on to api_serialize
+
+        pg
+            (optional) the page, if this is part of a paginated collection
+
+        total
+            (optional) total number of objects, if this is part of a paginated
+            collection
+
+        chunk_size
+            (optional) the number of objects to serialize at a time
+    '''
+
+    resp = StreamingHttpResponse(_stream_json_list(objs, request, chunk_size),
+            status=200, content_type='application/json; charset=utf-8')
+
+    if total is not None:
         resp.__setitem__('X-Object-Total', str(total))
         resp.__setitem__('X-Page-Number', str(pg))
 
     return resp
 
 
+def _iter_serialized(objs, request, chunk_size):
+    '''
+    Serializes a collection in lists of chunk_size. QuerySets are fetched a
+    chunk at a time (see _iter_chunks), so only one chunk is ever loaded.
+    '''
+
+    # Prepared once, rather than once per chunk
+    if isinstance(objs, QuerySet):
+        objs = api_prefetch(objs, request)
+
+    for chunk in _iter_chunks(objs, chunk_size):
+        # Dictionaries are already serialized
+        if not isinstance(chunk[0], dict):
+            chunk = api_serialize_many(chunk, request)
+        yield chunk
+
+
+def _stream_json_list(objs, request, chunk_size):
+    ''' Yields a json list of objs, one chunk at a time. '''
+
+    yield '['
+
+    first = True
+    for chunk in _iter_serialized(objs, request, chunk_size):
+        encoded = ','.join(codec.dumps(d) for d in chunk)
+        if not first:
+            encoded = ',' + encoded
+        first = False
+
+        yield encoded
+
+    yield ']'
+
+
 def APIResponseCreated(content=None, location=''):
     '''
     API wrapper for 201 HttpResonse (created)
@@ -53,13 +146,285 @@ def APIResponseCreated(content=None, location=''):
             The location (url) where this object can be located
     '''
 
-    content = json.dumps(content)
+    content = codec.dumps(content)
     resp = HttpResponse(status=201, mimetype='application/json; charset=utf-8', content=content)
     resp['Location'] = location
     return resp
 
 
-def api_serialize(obj, request = None, fields = ()):
+# The class attribute a SerializePlan is kept in. See _get_serialize_plan
+PLAN_ATTR = '_api_serialize_plan'
+
+# The classes a plan has been kept on, see clear_serialize_plans
+_planned_classes = []
+
+class SerializePlan(object):
+    '''
+    Everything api_serialize needs to know about a model class, worked out
+    once per class instead of once per object.
+
+    Interfaces (and the model itself, for api_serialize) may declare:
+
+        _api_keys (api_keys for the model)
+            A tuple of the keys their _api_serialize returns. If none of
+            them are requested (see get_field_selection) the method is not
+            called at all. Undeclared methods are always called.
+
+        _api_deferrable
+            A dictionary of key: field name, for (large) fields that can be
+            left out of the query when their key is not requested. The
+            _api_serialize method must not read these fields if they are
+            deferred (see is_deferred).
+
+    Models with a "modified" field (see Syncable) can have their
+    serialization cached, by setting api_fragment_cache = True on the model
+    or API_FRAGMENT_CACHE = True in the settings. What is cached is the
+    result of serializing without a request, under the model, pk and
+    modified time, so saving the model invalidates it. The parts that depend
+    on the request or on many to many relations (which don't change
+    modified) come from the _api_serialize_volatile methods of the
+    interfaces, which are called for every request.
+    '''
+
+    def __init__(self, cls):
+        self.cls = cls
+
+        # The model's own api_serialize method, if any
+        self.api_serialize = getattr(cls, 'api_serialize', None)
+        self.api_keys = getattr(cls, 'api_keys', None)
+
+        # Tuple made from summation of api_fields and _api_fields
+        fields = tuple(getattr(cls, 'api_fields', ()))
+
+        # The _api_serialize methods of each of the parent interfaces (one
+        # level deep), in base order, along with their _api_keys
+        self.interfaces = []
+
+        # The _api_prefetch (queryset) and _api_prefetch_objects (list of
+        # objects) hooks of the parent interfaces. See api_serialize_many
+        self.prefetchers = []
+        self.object_prefetchers = []
+
+        # The _api_serialize_volatile methods of the parent interfaces
+        self.volatile = []
+
+        self.deferrable = {}
+
+        for base in cls.__bases__:
+            if hasattr(base, '_api_serialize'):
+                self.interfaces.append((base, base._api_serialize, getattr(base, '_api_keys', None)))
+                self.deferrable.update(getattr(base, '_api_deferrable', {}))
+
+            elif hasattr(base, '_api_fields'):
+                fields += tuple(base._api_fields)
+
+            volatile = getattr(base, '_api_serialize_volatile', None)
+            if volatile:
+                self.volatile.append((volatile, getattr(base, '_api_keys', None)))
+
+            # Two interfaces can inherit the same hook, only run it once
+            prefetch = getattr(base, '_api_prefetch', None)
+            if prefetch and not prefetch in self.prefetchers:
+                self.prefetchers.append(prefetch)
+
+            prefetch = getattr(base, '_api_prefetch_objects', None)
+            if prefetch and not prefetch in self.object_prefetchers:
+                self.object_prefetchers.append(prefetch)
+
+        self.fields = fields
+        self.extractors = _compile_field_extractors(cls, fields)
+
+        self.has_absolute_url = hasattr(cls, 'get_absolute_url')
+        self.has_api_uri = hasattr(cls, 'get_api_uri')
+
+        self.fragment_cache = False
+        if hasattr(cls, '_meta') and 'modified' in [f.name for f in cls._meta.fields]:
+            self.fragment_cache = getattr(cls, 'api_fragment_cache',
+                    getattr(settings, 'API_FRAGMENT_CACHE', False))
+
+        if self.fragment_cache:
+            self.fragment_prefix = 'api_fragment:%s.%s:' % (cls._meta.app_label, cls._meta.object_name)
+
+
+def _compile_field_extractors(cls, fields):
+    '''
+    Returns a list of (name, function) which read the given fields off of
+    an object, giving the same values as django's python serializer.
+    '''
+
+    extractors = []
+    if not fields:
+        return extractors
+
+    opts = cls._meta.concrete_model._meta
+
+    # Same selection rules as django.core.serializers.base.Serializer
+    for field in opts.local_fields:
+        if field.serialize:
+            if field.rel is None:
+                if field.attname in fields:
+                    extractors.append((field.name, _value_extractor(field)))
+            else:
+                if field.attname[:-3] in fields:
+                    extractors.append((field.name, _fk_extractor(field)))
+
+    for field in opts.many_to_many:
+        if field.serialize and field.attname in fields:
+            # Django skips m2m fields with custom through models
+            if field.rel.through._meta.auto_created:
+                extractors.append((field.name, _m2m_extractor(field)))
+
+    return extractors
+
+
+def _value_extractor(field):
+    # Most fields read and convert their value the way Field does, which
+    # can be done without going back through the field.
+    cls = field.__class__
+    if (cls._get_val_from_obj.__func__ is Field._get_val_from_obj.__func__ and
+            cls.value_to_string.__func__ is Field.value_to_string.__func__):
+        attname = field.attname
+        def extract(obj):
+            value = getattr(obj, attname)
+            if is_protected_type(value):
+                return value
+            return smart_text(value)
+
+        return extract
+
+    def extract(obj):
+        value = field._get_val_from_obj(obj)
+        # Protected types (i.e., primitives like None, numbers, dates,
+        # and Decimals) are passed through as is. All other values are
+        # converted to string first.
+        if is_protected_type(value):
+            return value
+        return field.value_to_string(obj)
+
+    return extract
+
+
+def _fk_extractor(field):
+    attname = field.get_attname()
+    def extract(obj):
+        return getattr(obj, attname)
+
+    return extract
+
+
+def _m2m_extractor(field):
+    name = field.name
+    def extract(obj):
+        return [smart_text(related._get_pk_val(), strings_only=True)
+                for related in getattr(obj, name).iterator()]
+
+    return extract
+
+
+def _get_serialize_plan(cls):
+    '''
+    Returns the SerializePlan for a class, building it the first time the
+    class is seen. The plan is kept in the class' own __dict__ (subclasses
+    don't inherit it), so a class that is redefined (e.g. on reload) gets a
+    new plan.
+    '''
+
+    plan = cls.__dict__.get(PLAN_ATTR)
+    if plan is not None:
+        return plan
+
+    # Deferred querysets return instances of a generated subclass, which
+    # share the plan of their model
+    model = cls
+    if getattr(cls, '_deferred', False):
+        model = cls._meta.proxy_for_model
+
+    plan = model.__dict__.get(PLAN_ATTR) or SerializePlan(model)
+    for c in set([cls, model]):
+        setattr(c, PLAN_ATTR, plan)
+        _planned_classes.append(c)
+
+    return plan
+
+
+def clear_serialize_plans():
+    ''' Throws away all of the compiled serialization plans. '''
+
+    for cls in _planned_classes:
+        if PLAN_ATTR in cls.__dict__:
+            delattr(cls, PLAN_ATTR)
+
+    del _planned_classes[:]
+
+
+def get_field_selection(request):
+    '''
+    Returns a tuple of (fields, exclude), the sets of keys requested
+    through the comma separated "fields" and "exclude" parameters of a
+    request. Either may be empty. 
+    '''
+
+    if not hasattr(request, '_api_field_selection'):
+        selection = []
+        for param in ('fields', 'exclude'):
+            value = request.GET.get(param, '')
+            selection.append(frozenset(k.strip() for k in value.split(',') if k.strip()))
+
+        request._api_field_selection = tuple(selection)
+
+    return request._api_field_selection
+
+
+def _wanted(key, fields, exclude):
+    return (not fields or key in fields) and not key in exclude
+
+
+def _any_wanted(keys, fields, exclude):
+    # Undeclared keys are always wanted
+    if keys is None:
+        return True
+
+    for key in keys:
+        if _wanted(key, fields, exclude):
+            return True
+
+    return False
+
+
+def is_deferred(obj, field_name):
+    ''' Returns true if a field of obj was deferred, and has not been loaded. '''
+
+    if not getattr(obj, '_deferred', False):
+        return False
+
+    return not obj._meta.get_field(field_name).attname in obj.__dict__
+
+
+def api_defer(queryset, fields = (), exclude = ()):
+    '''
+    Defers the loading of the deferrable fields of a queryset whose keys
+    are not part of the field selection. See SerializePlan. Other fields,
+    auto fields included, are always loaded: the model's own methods (e.g.
+    get_absolute_url) may read them.
+    '''
+
+    if not (fields or exclude):
+        return queryset
+
+    plan = _get_serialize_plan(queryset.model)
+    defer = [f for k, f in plan.deferrable.items() if not _wanted(k, fields, exclude)]
+
+    # Only plain columns can be deferred
+    local = dict((f.name, f) for f in queryset.model._meta.fields)
+    defer = [f for f in defer if f in local and local[f].rel is None and not local[f].primary_key]
+
+    if defer:
+        queryset = queryset.defer(*defer)
+
+    return queryset
+
+
+def api_serialize(obj, request = None, fields = (), exclude = ()):
     '''
     Method used to serialize models. Iterates through all of the parent
     interfaces, joining together the results of _api_serialize methods 
@@ -67,17 +432,93 @@ def api_serialize(obj, request = None, fields = ()):
     of the api_serialize method of the model itself. Returns a 
     standard python dictionary.
 
+    The lookups needed to do this are done once per class, see
+    SerializePlan.
+
     Arguments:
 
         request
             Django http request object
 
         fields
-            Name of fields to auto serialize
+            Keys to include in the result (id is always included).
+            Defaults to the "fields" parameter of the request, if any.
+
+        exclude
+            Keys to leave out of the result. Defaults to the "exclude"
+            parameter of the request, if any.
+    '''
+
+    cls = obj.__class__
+    plan = cls.__dict__.get(PLAN_ATTR) or _get_serialize_plan(cls)
+
+    if request is not None and not (fields or exclude):
+        fields, exclude = get_field_selection(request)
+
+    # A deferred object can't be trusted to fill the cache
+    if plan.fragment_cache and not getattr(obj, '_deferred', False):
+        key = _fragment_key(obj, plan)
+        fragment = get_cache(key)
+        if fragment is None:
+            fragment = _serialize_all(obj, plan, None)
+            set_cache(key, fragment, timeout = _fragment_timeout())
+
+        return _serialize_from_fragment(obj, plan, fragment, request, fields, exclude)
+
+    if fields or exclude:
+        return _serialize(obj, plan, request, fields, exclude)
+
+    return _serialize_all(obj, plan, request)
+
+
+def _serialize_all(obj, plan, request):
     '''
+    Serializes every key of obj (see api_serialize). The same as _serialize
+    without a field selection, without checking each key against it.
+    '''
+
+    # Called first, but takes precedence over the rest
+    model_ser_dict = None
+    if plan.api_serialize:
+        model_ser_dict = plan.api_serialize(obj, request)
+        if model_ser_dict is None:
+            raise Exception('api_serialize returned no dictionary')
+
+    d = {}
+
+    # Auto fields, then the interfaces (and urls) on top of them
+    if plan.fields:
+        for name, extract in plan.extractors:
+            d[name] = extract(obj)
+
+        d['id'] = smart_text(obj._get_pk_val(), strings_only=True)
+
+    if hasattr(obj, 'id'):
+        d['id'] = obj.id
 
-    # Each of the parent interfaces
-    bases = obj.__class__.__bases__
+    for cls, ser, keys in plan.interfaces:
+        parent = ser(obj, request)
+        if parent is None:
+            raise Exception(str(cls) + ' _api_serialize returned no dictionary')
+
+        d.update(parent)
+
+    if plan.has_absolute_url:
+        abs_url = obj.get_absolute_url()
+        if abs_url:
+            d['url'] = abs_url
+
+    if plan.has_api_uri:
+        d['uri'] = obj.get_api_uri()
+
+    if model_ser_dict:
+        d.update(model_ser_dict)
+
+    return d
+
+
+def _serialize(obj, plan, request, fields, exclude):
+    ''' See api_serialize. Only used with a field selection. '''
 
     # Dict made from summation of dicts from _api_serialize (parent interfaces)
     parent_ser_dict = {} 
@@ -85,59 +526,205 @@ def api_serialize(obj, request = None, fields = ()):
     # Dict made from the model itself
     model_ser_dict = {} 
 
-    # Tuple made from summation of _api_fields
-    fields = ()
     fields_dict = {}
 
     # Init
-    if hasattr(obj, 'api_serialize'):
-        model_ser_dict = obj.api_serialize(request)
-        if model_ser_dict == None:
+    if plan.api_serialize and _any_wanted(plan.api_keys, fields, exclude):
+        model_ser_dict = plan.api_serialize(obj, request)
+        if model_ser_dict is None:
             raise Exception('api_serialize returned no dictionary')
 
-    if hasattr(obj, 'api_fields'):
-        fields = obj.api_fields
-
     if hasattr(obj, 'id'): 
         parent_ser_dict['id'] = obj.id
 
     # One level deep, chain together serialization results from parents.
-    for cls in bases:
-        if hasattr(cls, '_api_serialize'):
-            d = cls._api_serialize(obj, request)
-            if d == None:
-                raise Exception(str(cls) + ' _api_serialize returned no dictionary')
+    for cls, ser, keys in plan.interfaces:
+        if not _any_wanted(keys, fields, exclude):
+            continue
 
-            parent_ser_dict.update(d)
+        d = ser(obj, request)
+        if d is None:
+            raise Exception(str(cls) + ' _api_serialize returned no dictionary')
 
-        elif hasattr(cls, '_api_fields'):
-            fields += cls._api_fields;
+        parent_ser_dict.update(d)
 
     # Set the absolute url, if it exists
-    if hasattr(obj, 'get_absolute_url'): 
+    if plan.has_absolute_url and _wanted('url', fields, exclude):
         # Allows overring of default django absolute urls
         abs_url = obj.get_absolute_url()
         if abs_url: 
             parent_ser_dict['url'] = abs_url
 
     # Set the the api uri
-    if hasattr(obj, 'get_api_uri'): 
+    if plan.has_api_uri and _wanted('uri', fields, exclude):
         parent_ser_dict['uri'] = obj.get_api_uri()
 
     # If there were fields to auto serialize, do it
-    if len(fields) > 0:
-        serialized = serializers.serialize('python', [obj], fields=fields)
+    if len(plan.fields) > 0:
         # Dict made from auto serialization based on _api_fields
+        for name, extract in plan.extractors:
+            if _wanted(name, fields, exclude):
+                fields_dict[name] = extract(obj)
 
-        for s in serialized:
-            fields = s['fields']
-            fields_dict = fields
-            fields_dict['id'] = s['pk']
+        fields_dict['id'] = smart_text(obj._get_pk_val(), strings_only=True)
 
     # model_ser_dict gets precidence, then parent_ser_dict, then auto fields.
     fields_dict.update(parent_ser_dict)
     fields_dict.update(model_ser_dict)
-    return fields_dict
+
+    return _select(fields_dict, fields, exclude)
+
+
+def _select(d, fields, exclude):
+    ''' Removes the keys of d that are not part of the field selection. '''
+
+    if fields or exclude:
+        for key in d.keys():
+            if key != 'id' and not _wanted(key, fields, exclude):
+                del d[key]
+
+    return d
+
+
+def _fragment_key(obj, plan):
+    return plan.fragment_prefix + '%s:%s' % (obj.pk, obj.modified.isoformat())
+
+
+def _fragment_timeout():
+    return getattr(settings, 'API_FRAGMENT_CACHE_TIMEOUT', None)
+
+
+def _get_fragments(objs, plan):
+    '''
+    Returns a dictionary of id(obj): cached serialization for a list of
+    objects of a single class, with one call to the cache backend (plus
+    one to store any that were missing).
+    '''
+
+    keys = dict((_fragment_key(obj, plan), obj) for obj in objs)
+    fragments = get_many_cache(keys.keys())
+
+    missing = {}
+    for key, obj in keys.items():
+        if not key in fragments:
+            missing[key] = _serialize_all(obj, plan, None)
+
+    if missing:
+        set_many_cache(missing, timeout = _fragment_timeout())
+        fragments.update(missing)
+
+    return dict((id(obj), fragments[key]) for key, obj in keys.items())
+
+
+def _serialize_from_fragment(obj, plan, fragment, request, fields, exclude):
+    '''
+    Layers the volatile parts of the serialization on top of a cached one.
+    '''
+
+    d = dict(fragment)
+    for volatile, keys in plan.volatile:
+        if _any_wanted(keys, fields, exclude):
+            d.update(volatile(obj, request))
+
+    return _select(d, fields, exclude)
+
+
+def api_serialize_many(objs, request = None, fields = (), exclude = ()):
+    '''
+    Serializes a collection of objects, returning a list of dictionaries
+    (see api_serialize). Rather than letting each object load its related
+    data on its own, the interfaces of the model get a chance to load it for
+    the whole collection at once:
+
+        _api_prefetch(queryset, request)
+            Called with the queryset before it is evaluated. Returns a new
+            queryset, i.e. with select_related or prefetch_related applied.
+
+        _api_prefetch_objects(objs, request)
+            Called with the list of evaluated objects of a single class.
+
+    If a field selection is given, deferrable fields that are not selected
+    are not loaded (see api_defer). Cached serializations (see
+    SerializePlan) are fetched with a single get_many.
+
+    Arguments:
+
+        objs
+            A QuerySet or any other iterable of objects
+
+        request
+            Django http request object
+
+        fields, exclude
+            See api_serialize
+    '''
+
+    start_timer('serialization')
+
+    if request and not (fields or exclude):
+        fields, exclude = get_field_selection(request)
+
+    if isinstance(objs, QuerySet):
+        objs = api_prefetch(objs, request, fields, exclude)
+
+    objs = list(objs)
+
+    # Group by class, a collection may hold more than one model
+    by_class = {}
+    for obj in objs:
+        by_class.setdefault(obj.__class__, []).append(obj)
+
+    fragments = {}
+    for cls, cls_objs in by_class.items():
+        plan = _get_serialize_plan(cls)
+        for prefetch in plan.object_prefetchers:
+            prefetch(cls_objs, request)
+
+        if plan.fragment_cache and not getattr(cls, '_deferred', False):
+            fragments.update(_get_fragments(cls_objs, plan))
+
+    serialized = []
+    for obj in objs:
+        if id(obj) in fragments:
+            plan = _get_serialize_plan(obj.__class__)
+            serialized.append(_serialize_from_fragment(obj, plan, fragments[id(obj)], request, fields, exclude))
+        else:
+            serialized.append(api_serialize(obj, request, fields, exclude))
+
+    stop_timer('serialization')
+    return serialized
+
+
+def api_prefetch(queryset, request = None, fields = (), exclude = ()):
+    '''
+    Prepares a QuerySet to be serialized: applies the _api_prefetch hooks of
+    its model, and defers the fields that are not selected (see
+    api_serialize_many). Returns a new QuerySet.
+
+    Arguments:
+
+        queryset
+            The QuerySet to prepare
+
+        request
+            Django http request object
+
+        fields, exclude
+            See api_serialize. Defaults to the selection of the request.
+    '''
+
+    if request and not (fields or exclude):
+        fields, exclude = get_field_selection(request)
+
+    plan = _get_serialize_plan(queryset.model)
+    for prefetch in plan.prefetchers:
+        queryset = prefetch(queryset, request)
+
+    # Cached serializations are made from whole objects
+    if not plan.fragment_cache:
+        queryset = api_defer(queryset, fields, exclude)
+
+    return queryset
 
 
 def paginate(objs, request_dict):
@@ -151,11 +738,12 @@ def paginate(objs, request_dict):
             The collection of objects to paginate
 
         request_dict
-            Dictionary of request parameters
+            Dictionary of request parameters. The "count" parameter picks
+            how the total is found, see get_total.
     '''
 
     pg = 1
-    total = len(objs)
+    total = get_total(objs, request_dict.get('count', None))
 
     # Paginate the results.
     if 'pagesize' in request_dict:
@@ -172,15 +760,222 @@ def paginate(objs, request_dict):
         except ValueError, e:
             raise exceptions.InvalidParameterException('Invalid page number')
 
-        p = Paginator(objs, pgsize)
-        try:
-            objs = p.page(pg).object_list
-        except EmptyPage:
+        # Sliced here rather than with a Paginator, which would count again
+        bottom = (pg - 1) * pgsize
+        if total is not None and pg > 1 and bottom >= total:
             raise exceptions.APIBadRequest('Empty Page')
 
+        objs = objs[bottom:bottom + pgsize]
+
     return objs, total, pg
 
 
+def get_total(objs, mode = None):
+    '''
+    Returns the total number of objects in a collection, according to mode:
+
+        None, 'true' or 'exact'
+            A real count. For a QuerySet this is a COUNT(*), which is cached
+            per query for API_COUNT_CACHE_TIMEOUT (30) seconds.
+
+        'estimate'
+            The planner's estimate of the number of rows (PostgreSQL only).
+            Estimates under API_COUNT_ESTIMATE_THRESHOLD (1000) are not
+            worth the inaccuracy, and are replaced by a real count.
+
+        'false'
+            No count at all. Returns None.
+    '''
+
+    if mode:
+        mode = mode.lower()
+
+    if mode == 'false':
+        return None
+
+    if not isinstance(objs, QuerySet):
+        return len(objs)
+
+    try:
+        sql, params = objs.query.get_compiler(objs.db).as_sql()
+    except EmptyResultSet:
+        return 0
+
+    if mode == 'estimate':
+        estimate = _estimate_count(objs.db, sql, params)
+        if estimate is not None and estimate >= getattr(settings, 'API_COUNT_ESTIMATE_THRESHOLD', 1000):
+            return estimate
+
+    elif mode not in (None, 'true', 'exact'):
+        raise exceptions.InvalidParameterException('Invalid count: ' + mode)
+
+    key = 'count:' + hashlib.md5(stable_repr((objs.db, sql, params))).hexdigest()
+    total = get_cache(key)
+    if total is None:
+        total = objs.count()
+        set_cache(key, total, timeout = getattr(settings, 'API_COUNT_CACHE_TIMEOUT', 30))
+
+    return total
+
+
+def stable_repr(value):
+    '''
+    A repr of a value that is the same for equal values in every request,
+    to make cache keys from. Geometries, and the database adapters made
+    from them, are represented by their (E)WKB or WKT rather than by
+    their address. Tuples, lists and Q objects are gone through.
+    '''
+
+    if isinstance(value, Q):
+        return 'Q(%s,%s,%s)' % (value.connector, value.negated, stable_repr(value.children))
+
+    if isinstance(value, (list, tuple)):
+        return '(%s)' % ','.join(stable_repr(v) for v in value)
+
+    ewkb = getattr(value, 'ewkb', None)
+    if ewkb is not None:
+        return 'ewkb(%s)' % binascii.hexlify(bytes(ewkb))
+
+    wkt = getattr(value, 'wkt', None)
+    if wkt is not None:
+        return 'wkt(%s,%s)' % (wkt, getattr(value, 'srid', None))
+
+    return repr(value)
+
+
+def _estimate_count(db, sql, params):
+    ''' The number of rows PostgreSQL expects a query to return, or None. '''
+
+    connection = connections[db]
+    if connection.vendor != 'postgresql':
+        return None
+
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN ' + sql, params)
+    match = re.search(r'rows=(\d+)', cursor.fetchone()[0])
+    if match:
+        return int(match.group(1))
+
+    return None
+
+
+def paginate_cursor(objs, request_dict, order_by = ('modified', 'id')):
+    '''
+    Paginates a QuerySet using a cursor rather than a page number. The
+    objects are ordered by order_by, and each page picks up where the last
+    one left off (WHERE (modified, id) > (last modified, last id)), so the
+    cost of a page stays the same however far into the collection it is,
+    and nothing is counted. 
+    
+    The cursor of the next page (see APIResponseOK) is None on the last page.
+    Returns a tuple of (objs, cursor).
+
+    Arguments:
+
+        objs
+            The QuerySet to paginate
+
+        request_dict
+            Dictionary of request parameters. Uses "cursor" and "pagesize".
+            Defaults to API_DEFAULT_PAGESIZE (100) objects per page.
+
+        order_by
+            A tuple of field names to order by, which together must be
+            unique and should be indexed. Use a leading - for descending.
+    '''
+
+    try:
+        pgsize = int(request_dict.get('pagesize', getattr(settings, 'API_DEFAULT_PAGESIZE', 100)))
+        if pgsize < 1:
+            raise ValueError
+    except ValueError:
+        raise exceptions.InvalidParameterException('Invalid page size')
+
+    objs = objs.order_by(*order_by)
+
+    cursor = request_dict.get('cursor', None)
+    if cursor:
+        values = _decode_cursor(cursor)
+        if len(values) != len(order_by):
+            raise exceptions.InvalidParameterException('Invalid cursor')
+
+        # The values are the client's, and may not fit the fields
+        try:
+            objs = objs.filter(_cursor_query(order_by, values))
+        except (ValidationError, ValueError, TypeError):
+            raise exceptions.InvalidParameterException('Invalid cursor')
+
+    # One more than needed, to know if there is a next page
+    objs = list(objs[:pgsize + 1])
+
+    next_cursor = None
+    if len(objs) > pgsize:
+        objs = objs[:pgsize]
+        last = objs[-1]
+        next_cursor = _encode_cursor([getattr(last, f.lstrip('-')) for f in order_by])
+
+    return objs, next_cursor
+
+
+def _cursor_query(order_by, values):
+    '''
+    Returns a Q object for the rows after values, in order_by order. i.e.
+    for (a, b): a > va OR (a = va AND b > vb)
+    '''
+
+    terms = []
+    for i, field in enumerate(order_by):
+        term = [Q(**{f.lstrip('-'): v}) for f, v in zip(order_by[:i], values[:i])]
+
+        if field.startswith('-'):
+            term.append(Q(**{field[1:] + '__lt': values[i]}))
+        else:
+            term.append(Q(**{field + '__gt': values[i]}))
+
+        terms.append(reduce(operator.and_, term))
+
+    return reduce(operator.or_, terms)
+
+
+# Cursor dates keep their microseconds, unlike DATE_FORMAT
+CURSOR_DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def _encode_cursor(values):
+    ''' Encodes a list of values into an opaque, url safe string. '''
+
+    encoded = []
+    for v in values:
+        if isinstance(v, datetime):
+            if timezone.is_aware(v):
+                v = ['dtz', timezone.make_naive(v, timezone.utc).strftime(CURSOR_DATE_FORMAT)]
+            else:
+                v = ['dt', v.strftime(CURSOR_DATE_FORMAT)]
+        encoded.append(v)
+
+    return base64.urlsafe_b64encode(codec.dumps(encoded))
+
+
+def _decode_cursor(cursor):
+    ''' The reverse of _encode_cursor. Raises InvalidParameterException. '''
+
+    try:
+        encoded = codec.loads(base64.urlsafe_b64decode(str(cursor)))
+
+        values = []
+        for v in encoded:
+            if isinstance(v, list):
+                dt = datetime.strptime(v[1], CURSOR_DATE_FORMAT)
+                if v[0] == 'dtz':
+                    dt = timezone.make_aware(dt, timezone.utc)
+                v = dt
+            values.append(v)
+
+    except (TypeError, ValueError, IndexError, binascii.Error):
+        raise exceptions.InvalidParameterException('Invalid cursor')
+
+    return values
+
+
 def form_validate(formclass, data, instance=None, commit=True):
     '''
     Uses a form to validate data passed in as a dictionary. See
@@ -210,7 +1005,7 @@ def form_validate(formclass, data, instance=None, commit=True):
             if conflicting and hasattr(conflicting, 'get_api_uri'):
                 form.errors['uri'] = conflicting.get_api_uri()
 
-        raise exceptions.APIBadRequest(json.dumps(form.errors))
+        raise exceptions.APIBadRequest(codec.dumps(form.errors))
 
     return form.save(commit=commit)
 
@@ -219,7 +1014,7 @@ def get_json(raw_data):
     data = None
 
     try:
-        data = json.loads(raw_data)
+        data = codec.loads(raw_data)
     except ValueError:
         raise exceptions.APIBadRequest('Invalid JSON')
 
@@ -274,11 +1069,136 @@ def get_param(dict, param):
 def geojson_serialize(obj, geometry, request):
     d = dict(type = 'Feature', id = obj.id) 
 
-    d['geometry'] = json.loads(geometry.geojson)
+    d['geometry'] = codec.loads(geometry.geojson)
     if hasattr(obj, 'geojson_properties'):
         d['properties'] = obj.geojson_properties(request)
     return d
 
+def geojson_serialize_many(objs, geometry_field, request = None, chunk_size = 500):
+    '''
+    Yields a GeoJSON FeatureCollection of objs as json text, chunk_size
+    features at a time. Properties come from the geojson_properties method
+    of each object, as with geojson_serialize.
+
+    For a GeoQuerySet the geometries are exported as GeoJSON by the database
+    and spliced into the output as is, without ever being loaded into GEOS
+    or parsed. Otherwise (or if the GeoQuerySet was already sliced, i.e. by
+    paginate) the GeoJSON text of each geometry is used.
+
+    Arguments:
+
+        objs
+            A GeoQuerySet, or any iterable of objects
+
+        geometry_field
+            The name of the geometry field to use, e.g. location
+
+        request
+            Django http request object, passed to geojson_properties
+    '''
+
+    # geojson() adds to the query, which can't be done once it's sliced
+    annotated = hasattr(objs, 'geojson') and objs.query.can_filter()
+    if annotated:
+        objs = objs.geojson(field_name=geometry_field, model_att='_api_geojson') \
+                .defer(geometry_field)
+
+    yield '{"type": "FeatureCollection", "features": ['
+
+    first = True
+    for chunk in _iter_chunks(objs, chunk_size):
+        features = []
+        for obj in chunk:
+            if annotated:
+                geometry = obj._api_geojson
+            else:
+                geometry = getattr(obj, geometry_field)
+                if geometry:
+                    geometry = geometry.geojson
+
+            properties = None
+            if hasattr(obj, 'geojson_properties'):
+                properties = obj.geojson_properties(request)
+
+            features.append('{"type": "Feature", "id": %s, "geometry": %s, "properties": %s}' % (
+                codec.dumps(obj.id), geometry or 'null', codec.dumps(properties)))
+
+        encoded = ','.join(features)
+        if not first:
+            encoded = ',' + encoded
+        first = False
+
+        yield encoded
+
+    yield ']}'
+
+
+def _iter_chunks(objs, chunk_size):
+    '''
+    Splits a collection into lists of chunk_size. QuerySets are fetched a
+    chunk at a time, so only one chunk is ever loaded. A QuerySet that was
+    already sliced (i.e. a page, see paginate) can't be reordered, and is
+    fetched in one query.
+
+    A QuerySet ordered by pk (as an unordered one is made to be) is fetched
+    from one pk to the next (WHERE pk > last pk), which costs the same for
+    every chunk, and doesn't skip or repeat rows written in the meantime.
+    Other orderings are fetched by offset.
+    '''
+
+    if isinstance(objs, QuerySet) and objs.query.can_filter():
+        # Slices of an unordered queryset may overlap
+        if not objs.ordered:
+            objs = objs.order_by('pk')
+
+        if _pk_ordered(objs):
+            chunk = list(objs[:chunk_size])
+            while chunk:
+                yield chunk
+                if len(chunk) < chunk_size:
+                    return
+                chunk = list(objs.filter(pk__gt = chunk[-1].pk)[:chunk_size])
+            return
+
+        start = 0
+        while True:
+            chunk = list(objs[start:start + chunk_size])
+            if chunk:
+                yield chunk
+            if len(chunk) < chunk_size:
+                return
+            start += chunk_size
+
+    else:
+        objs = iter(objs)
+        while True:
+            chunk = list(islice(objs, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+
+def _pk_ordered(queryset):
+    ''' Whether a QuerySet of model instances is ordered by ascending pk only. '''
+
+    if isinstance(queryset, ValuesQuerySet):
+        return False
+
+    query = queryset.query
+    ordering = query.order_by or (query.default_ordering and queryset.model._meta.ordering) or []
+    return list(ordering) in (['pk'], [queryset.model._meta.pk.name])
+
+
+def APIResponseFeatureCollection(objs, geometry_field, request = None, chunk_size = 500):
+    '''
+    A streaming 200 HttpResponse of a GeoJSON FeatureCollection. See
+    geojson_serialize_many.
+    '''
+
+    return StreamingHttpResponse(geojson_serialize_many(objs, geometry_field, request, chunk_size),
+            status=200, content_type='application/json; charset=utf-8')
+
+
 # Take in a string of coordinates and return a query object that checks
 # if a point is within it Q(location__within=poly)
 #
@@ -296,4 +1216,5 @@ def get_polygon_bounds_query(bounds_str, field):
     poly = Polygon.from_bbox(bbox)
     poly.set_srid(4326)
 
-    return Q(**{field + '__within': poly})
+    # The && operator uses the index, before the exact test
+    return Q(**{field + '__bboverlaps': poly}) & Q(**{field + '__within': poly})
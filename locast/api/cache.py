@@ -1,18 +1,95 @@
 # A wrapper for django cache with support for cache groups
+#
+# A cache group is a version number kept in the cache, which is part of the
+# key of every value in the group, so incrementing it (incr_group)
+# invalidates the whole group at once.
+#
+# Group versions are also remembered by each process for
+# API_CACHE_GROUP_TTL seconds (default 5), shared by all of its threads.
+# Within that time, getting or setting a value is a single call to the cache
+# backend. After it, the group version is checked in the same call as the
+# value (see get_cache). An incr_group in another process is therefore seen
+# within API_CACHE_GROUP_TTL seconds. Set it to 0 to always check.
+#
+# Values set with set_cache (other than numbers) are pickled here rather
+# than by the backend, and compressed if they are larger than
+# API_CACHE_COMPRESS_THRESHOLD bytes (default 1024, None to turn it off),
+# with zlib at API_CACHE_COMPRESS_LEVEL (default 1: JSON shrinks to a fifth
+# or so even at the fastest level). Stored values start with a header
+# marking the codec, and get_cache undoes it.
 
+import cPickle as pickle
 import hashlib
+import os
+import socket
+import threading
+import time
+import zlib
 
+from django.conf import settings
 from django.core.cache import cache
+from django.db.models import signals
+from django.utils import translation
 
-def _cache_key(key, cache_group = None):
+# cache_group: (version, time it was read from the cache)
+_group_versions = {}
+_group_versions_lock = threading.Lock()
+
+def _group_ttl():
+    return getattr(settings, 'API_CACHE_GROUP_TTL', 5)
+
+def _local_group_version(cache_group):
+    '''
+    Returns (version, fresh) for a group from the process' map. The version
+    is None if the process has not seen the group.
+    '''
+
+    entry = _group_versions.get(cache_group)
+    if entry is None:
+        return None, False
+
+    return entry[0], (time.time() - entry[1] < _group_ttl())
+
+def _remember_group_version(cache_group, version):
+    with _group_versions_lock:
+        _group_versions[cache_group] = (version, time.time())
+
+def _new_group_version(cache_group):
+    '''
+    Starts a group that is not in the cache, either new or evicted. Versions
+    start from the current time, so that a group that was evicted can not
+    go back to a version whose values are still in the cache.
+    '''
+
+    version = int(time.time() * 1000)
+    timeout = getattr(settings, 'API_CACHE_GROUP_TIMEOUT', 60 * 60 * 24 * 30)
+    if cache.add(cache_group, version, timeout):
+        return version
+
+    # Another process got there first
+    return cache.get(cache_group) or version
+
+def _group_version(cache_group):
+    ''' Returns the current version of a group. '''
+
+    version, fresh = _local_group_version(cache_group)
+    if fresh:
+        return version
+
+    version = cache.get(cache_group)
+    if version is None:
+        version = _new_group_version(cache_group)
+
+    _remember_group_version(cache_group, version)
+    return version
+
+def _cache_key(key, cache_group = None, version = None):
     combined_key = ''
     if cache_group:
-        group_val = cache.get(cache_group)
-        if not group_val:
-            group_val = 1
-            cache.set(cache_group, group_val)
+        if version is None:
+            version = _group_version(cache_group)
 
-        combined_key = cache_group + str(cache.get(cache_group, 1)) + ':'
+        combined_key = cache_group + str(version) + ':'
 
     combined_key += key
     hashed_key = hashlib.md5(combined_key).hexdigest()
@@ -23,21 +100,621 @@ def incr_group(cache_group):
     '''
     Invalidate the previous group
     '''
-    if cache.get(cache_group):
-        cache.incr(cache_group)
 
-def set_cache(key, value, cache_group=None):
+    try:
+        version = cache.incr(cache_group)
+    except ValueError:
+        # Not in the cache
+        version = _new_group_version(cache_group)
+
+    _remember_group_version(cache_group, version)
+    incr_stat(cache_group, 'invalidations')
+
+# Header of packed values, followed by a codec and a format byte
+PACKED_MAGIC = '\x00lc'
+
+# codec byte: (compress, decompress)
+CODECS = {
+    'n': (None, None),
+    'z': (zlib.compress, zlib.decompress),
+}
+
+def _pack(value, cache_group = None, stats = True):
+    '''
+    Returns a value as it is stored in the cache backend (see above), and
+    records its size in the "raw_bytes" and "bytes" statistics (unless
+    stats is False).
+    '''
+
+    # Numbers are left as they are, so they can be incremented. Not bools,
+    # which some backends (i.e. python-memcached) give back as ints.
+    if value is None or (isinstance(value, (int, long, float)) and not isinstance(value, bool)):
+        return value
+
+    if isinstance(value, str):
+        format, data = 's', value
+    else:
+        format, data = 'p', pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    if stats:
+        incr_stat(cache_group, 'raw_bytes', len(data))
+
+    codec = 'n'
+    threshold = getattr(settings, 'API_CACHE_COMPRESS_THRESHOLD', 1024)
+    if threshold is not None and len(data) > threshold:
+        compressed = zlib.compress(data, getattr(settings, 'API_CACHE_COMPRESS_LEVEL', 1))
+
+        # Data that is already compressed can grow
+        if len(compressed) < len(data):
+            codec, data = 'z', compressed
+
+    # Strings are stored as they are, unless they could be mistaken for a
+    # packed value
+    if not (codec == 'n' and format == 's' and not data.startswith(PACKED_MAGIC)):
+        data = PACKED_MAGIC + codec + format + data
+
+    if stats:
+        incr_stat(cache_group, 'bytes', len(data))
+    return data
+
+def _unpack(value):
+    ''' Returns a value from the cache backend as it was set. '''
+
+    if not isinstance(value, str) or not value.startswith(PACKED_MAGIC):
+        return value
+
+    start = len(PACKED_MAGIC)
+    codec, format = value[start], value[start + 1]
+    data = value[start + 2:]
+
+    decompress = CODECS[codec][1]
+    if decompress:
+        data = decompress(data)
+
+    if format == 'p':
+        return pickle.loads(data)
+
+    return data
+
+def set_cache(key, value, cache_group=None, timeout=None, stats=True):
+    if stats:
+        incr_stat(cache_group, 'sets')
+
+    key = _cache_key(key, cache_group)
+    cache.set(key, _pack(value, cache_group, stats), timeout)
+
+def get_cache(key, cache_group=None, stats=True):
+    value = _unpack(_get_cache(key, cache_group))
+    if stats:
+        incr_stat(cache_group, 'misses' if value is None else 'hits')
+    return value
+
+def _get_cache(key, cache_group):
+    if not cache_group:
+        return cache.get(_cache_key(key))
+
+    version, fresh = _local_group_version(cache_group)
+
+    if fresh or version is None:
+        return cache.get(_cache_key(key, cache_group, version))
+
+    # The remembered version is out of date: get the group along with the
+    # value under the remembered version, which is right unless the group
+    # was invalidated.
+    hashed_key = _cache_key(key, cache_group, version)
+    found = cache.get_many([cache_group, hashed_key])
+
+    current = found.get(cache_group)
+    if current is None:
+        current = _new_group_version(cache_group)
+
+    _remember_group_version(cache_group, current)
+
+    if current == version:
+        return found.get(hashed_key)
+
+    return cache.get(_cache_key(key, cache_group, current))
+
+def add_cache(key, value, cache_group=None, timeout=None):
+    '''
+    Sets a value only if the key is not already set. Returns True if it was
+    set, which makes it usable as a lock.
+    '''
+
     key = _cache_key(key, cache_group)
-    cache.set(key, value)
+    return cache.add(key, _pack(value, cache_group, False), timeout)
 
-def get_cache(key, cache_group=None):
+def delete_cache(key, cache_group=None):
     key = _cache_key(key, cache_group)
-    return cache.get(key)
+    cache.delete(key)
+
+def set_many_cache(data, cache_group=None, timeout=None, stats=True):
+    '''
+    Sets a dictionary of key: value in one call to the cache backend.
+    '''
+
+    if stats:
+        incr_stat(cache_group, 'sets', len(data))
+
+    version = cache_group and _group_version(cache_group)
+    cache.set_many(dict((_cache_key(k, cache_group, version), _pack(v, cache_group, stats))
+        for k, v in data.items()), timeout)
+
+def get_many_cache(keys, cache_group=None, stats=True):
+    '''
+    Gets a list of keys in one call to the cache backend. Returns a
+    dictionary of key: value, for the keys that were found.
+    '''
+
+    version = cache_group and _group_version(cache_group)
+    hashed = dict((_cache_key(k, cache_group, version), k) for k in keys)
+    found = cache.get_many(hashed.keys())
+
+    if stats:
+        incr_stat(cache_group, 'hits', len(found))
+        incr_stat(cache_group, 'misses', len(hashed) - len(found))
+
+    return dict((hashed[h], _unpack(v)) for h, v in found.items())
+
+# Model invalidation
+#
+# Rather than calling incr_group after every write, a model can be
+# registered with the groups that depend on it. ModelBase.save and delete,
+# and changes to many to many relations, then invalidate exactly those.
+
+# model: [(cache_group, frozenset of field names, or None for any change)]
+_model_groups = {}
+
+# Registrations of each class, including those of its bases
+_resolved_groups = {}
+
+# Fields compared between loading and saving, for each class
+_resolved_tracked = {}
+
+def register_cache_group(model, cache_group, fields = None):
+    '''
+    Registers a cache group to be invalidated when an instance of a model
+    (or of any subclass, so interfaces can be registered) is saved or
+    deleted, or one of its many to many relations changes.
+
+    Arguments:
+
+        model
+            The model class or interface
+
+        cache_group
+            The cache group to invalidate
+
+        fields (optional)
+            Only invalidate when one of these fields changed. Many to many
+            fields can be given too. Creation and deletion always
+            invalidate.
+    '''
+
+    if fields:
+        fields = frozenset(fields)
+        signals.post_init.connect(_snapshot_instance, dispatch_uid='locast_cache_snapshot')
+
+    _model_groups.setdefault(model, []).append((cache_group, fields or None))
+    signals.m2m_changed.connect(_m2m_changed, dispatch_uid='locast_cache_m2m')
+
+    _resolved_groups.clear()
+    _resolved_tracked.clear()
+
+def _groups_for(cls):
+    groups = _resolved_groups.get(cls)
+    if groups is None:
+        groups = []
+        for c in cls.__mro__:
+            groups.extend(_model_groups.get(c, []))
+
+        _resolved_groups[cls] = groups
+
+    return groups
+
+def _tracked_fields(cls):
+    ''' (name, attname) of the non m2m fields that registrations depend on. '''
+
+    tracked = _resolved_tracked.get(cls)
+    if tracked is None:
+        names = set()
+        for cache_group, fields in _groups_for(cls):
+            if fields:
+                names.update(fields)
+
+        tracked = [(f.name, f.attname) for f in cls._meta.fields if f.name in names]
+        _resolved_tracked[cls] = tracked
+
+    return tracked
+
+def _snapshot_instance(sender, instance, **kwargs):
+    tracked = _tracked_fields(sender)
+    if tracked:
+        # Read from __dict__, so deferred fields are not loaded
+        instance._cache_group_snapshot = dict((name, instance.__dict__.get(attname))
+                for name, attname in tracked)
+
+def get_changed_fields(instance):
+    '''
+    Returns the set of tracked fields (see register_cache_group) that
+    changed since the instance was loaded or last saved, or None if that is
+    not known.
+    '''
+
+    snapshot = getattr(instance, '_cache_group_snapshot', None)
+    if snapshot is None:
+        return None
+
+    return set(name for name, attname in _tracked_fields(instance.__class__)
+            if snapshot.get(name) != instance.__dict__.get(attname))
+
+def invalidate_instance(instance, changed = None):
+    '''
+    Invalidates the cache groups registered for the class of an instance,
+    which has just been saved or deleted.
+
+    Arguments:
+
+        changed (optional)
+            The set of field names that changed. None if it is not known, or
+            the instance was created or deleted, which invalidates all of
+            the groups.
+    '''
+
+    _invalidate_groups(instance.__class__, changed)
+
+    # Later changes are compared to what was saved
+    _snapshot_instance(instance.__class__, instance)
+
+def _invalidate_groups(cls, changed):
+    for cache_group, fields in _groups_for(cls):
+        if changed is None or fields is None or (fields & changed):
+            _invalidate(cache_group)
+
+def _m2m_field_name(cls, through):
+    for f in cls._meta.many_to_many:
+        if f.rel.through is through:
+            return f.name
+
+    return None
+
+def _m2m_changed(sender, instance, action, reverse, model, **kwargs):
+    if not action in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        # Not invalidate_instance, which would take the unsaved changes of
+        # the instance as saved
+        name = _m2m_field_name(instance.__class__, sender)
+        if name:
+            _invalidate_groups(instance.__class__, set([name]))
 
-# TODO: if passed a query_dict, ignore all query parameters
-# not in the query_dict
+    # The change was made from the other side, i.e. user.favorite_x.add()
+    else:
+        name = _m2m_field_name(model, sender)
+        for cache_group, fields in _groups_for(model):
+            if fields is None or name in fields:
+                _invalidate(cache_group)
 
-def request_cache_key(request, user_specific = False, ignore_params = None):
+# Coalescing of invalidations within a request or transaction
+_coalescing = threading.local()
+
+def _invalidate(cache_group):
+    pending = getattr(_coalescing, 'groups', None)
+    if pending is not None:
+        pending.add(cache_group)
+    else:
+        incr_group(cache_group)
+
+def start_coalescing():
+    '''
+    Starts collecting invalidations made through register_cache_group, in
+    this thread, rather than applying them. Calls can be nested.
+    '''
+
+    if getattr(_coalescing, 'depth', 0) == 0:
+        _coalescing.groups = set()
+        _coalescing.depth = 0
+
+    _coalescing.depth += 1
+
+def finish_coalescing():
+    ''' Ends start_coalescing, invalidating each collected group once. '''
+
+    depth = getattr(_coalescing, 'depth', 0)
+    if depth == 0:
+        return
+
+    _coalescing.depth = depth - 1
+    if _coalescing.depth == 0:
+        groups = _coalescing.groups
+        _coalescing.groups = None
+        for cache_group in groups:
+            incr_group(cache_group)
+
+def flush_coalescing():
+    '''
+    Ends any start_coalescing calls left unfinished in this thread (i.e. by
+    a request that failed), invalidating the groups they collected.
+    '''
+
+    if getattr(_coalescing, 'depth', 0):
+        _coalescing.depth = 1
+        finish_coalescing()
+
+class coalesce_invalidation(object):
+    '''
+    A context manager which coalesces the invalidations made within it
+    (i.e. around a transaction). See start_coalescing.
+
+    with coalesce_invalidation():
+        ...
+    '''
+
+    def __enter__(self):
+        start_coalescing()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        finish_coalescing()
+
+# Statistics
+#
+# Counted per cache group in each process. Every
+# API_CACHE_STATS_FLUSH_INTERVAL seconds (default 60), the request that
+# notices writes the totals of its process to the cache backend, so that
+# they can be read from any process (see get_stats). Each process only ever
+# writes its own keys, so a flush is one get_many (of the index of
+# processes and groups, along with the warming samples) and one set_many,
+# however many groups and statistics there are.
+#
+#   hits, misses        get_cache and get_many_cache lookups
+#   sets                values set
+#   raw_bytes, bytes    size of the values set (other than numbers),
+#                       before and after compression
+#   recomputed, fill_ms responses computed by cache_api_response, and the
+#                       milliseconds spent computing them
+#   invalidations       incr_group calls
+#   coalesced_wait, coalesced_stale, lock_timeout
+#                       see cache_api_response
+#
+# Lookups and sets made with stats=False (i.e. for the bookkeeping of
+# cache_api_response) are not counted.
+
+UNGROUPED = '(ungrouped)'
+
+# { 'epoch': reset_stats time, 'processes': set, 'groups': set, 'written': time }
+STATS_INDEX_KEY = 'locast_stats:index'
+
+# (cache_group, name): count, not yet flushed
+_stats = {}
+_stats_lock = threading.Lock()
+_stats_flushed = [time.time()]
+
+# (cache_group, name): count, flushed by this process within the epoch
+_stats_totals = {}
+
+# (pid, epoch) of _stats_totals
+_stats_owner = [None]
+
+def incr_stat(cache_group, name, amount = 1):
+    ''' Adds to one of the statistics of a cache group. '''
+
+    with _stats_lock:
+        key = (cache_group or UNGROUPED, name)
+        _stats[key] = _stats.get(key, 0) + amount
+
+    if time.time() - _stats_flushed[0] > getattr(settings, 'API_CACHE_STATS_FLUSH_INTERVAL', 60):
+        flush_stats()
+
+def _stat_key(epoch, process, cache_group, name):
+    return _cache_key('locast_stats:%s:%s:%s:%s' % (epoch, process, cache_group, name))
+
+def _stats_process():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+def _new_stats_index(epoch = 0):
+    return {'epoch': epoch, 'processes': set(), 'groups': set(), 'written': 0}
+
+def flush_stats():
+    ''' Writes the statistics of this process to the cache. '''
+
+    with _stats_lock:
+        stats = dict(_stats)
+        _stats.clear()
+        _stats_flushed[0] = time.time()
+        samples = dict(_samples)
+        _samples.clear()
+
+    if not stats and not samples:
+        return
+
+    timeout = getattr(settings, 'API_CACHE_STATS_TIMEOUT', 60 * 60 * 24 * 7)
+
+    found = cache.get_many([STATS_INDEX_KEY, WARM_SAMPLES_KEY])
+    index = found.get(STATS_INDEX_KEY) or _new_stats_index()
+    values = {}
+
+    if samples:
+        values[WARM_SAMPLES_KEY] = _add_samples(found.get(WARM_SAMPLES_KEY) or {}, samples)
+
+    if stats:
+        process = _stats_process()
+
+        with _stats_lock:
+            # Start over in a forked process, or after reset_stats
+            owner = (os.getpid(), index['epoch'])
+            if _stats_owner[0] != owner:
+                _stats_totals.clear()
+                _stats_owner[0] = owner
+
+            for key, count in stats.items():
+                _stats_totals[key] = _stats_totals.get(key, 0) + count
+
+            totals = dict(_stats_totals)
+
+        for (cache_group, name), count in totals.items():
+            values[_stat_key(index['epoch'], process, cache_group, name)] = count
+
+        groups = set(cache_group for cache_group, name in totals.keys())
+        if (process not in index['processes'] or not groups <= index['groups']
+                or time.time() - index['written'] > timeout / 2):
+            index['processes'].add(process)
+            index['groups'] |= groups
+            index['written'] = time.time()
+            values[STATS_INDEX_KEY] = index
+
+    cache.set_many(values, timeout)
+
+STAT_NAMES = ('hits', 'misses', 'sets', 'raw_bytes', 'bytes', 'recomputed', 'fill_ms', 'invalidations',
+        'coalesced_wait', 'coalesced_stale', 'lock_timeout')
+
+def get_stats():
+    '''
+    Returns the statistics of all processes, as far as they have been
+    flushed, as a dictionary of cache_group: { name: count }
+    '''
+
+    flush_stats()
+
+    index = cache.get(STATS_INDEX_KEY) or _new_stats_index()
+    keys = dict((_stat_key(index['epoch'], p, g, n), (p, g, n))
+        for p in index['processes'] for g in index['groups'] for n in STAT_NAMES)
+    found = cache.get_many(keys.keys())
+
+    stats = dict((g, dict((n, 0) for n in STAT_NAMES)) for g in index['groups'])
+    processes = set()
+    for key, count in found.items():
+        process, cache_group, name = keys[key]
+        stats[cache_group][name] += count
+        processes.add(process)
+
+    # Forget the processes whose totals have expired
+    if processes != index['processes']:
+        index['processes'] = processes
+        cache.set(STATS_INDEX_KEY, index, getattr(settings, 'API_CACHE_STATS_TIMEOUT', 60 * 60 * 24 * 7))
+
+    return stats
+
+def reset_stats():
+    '''
+    Clears all of the statistics, by starting a new epoch. The totals of the
+    previous one are left to expire.
+    '''
+
+    with _stats_lock:
+        _stats.clear()
+
+    cache.set(STATS_INDEX_KEY, _new_stats_index(int(time.time() * 1000)),
+        getattr(settings, 'API_CACHE_STATS_TIMEOUT', 60 * 60 * 24 * 7))
+
+# Warming
+#
+# cache_api_response records a sample of the requests it answers
+# (API_CACHE_WARM_SAMPLE_RATE, default 0.01, 0 to turn it off), with the
+# time it took to compute them. The samples of each process are added to
+# totals in the cache backend along with the statistics, keeping the
+# API_CACHE_WARM_MAX_URLS (1000) most requested urls. The cache_warm
+# management command requests the most requested urls again, i.e. after a
+# deploy, so that their responses are cached before users ask for them.
+
+WARM_SAMPLES_KEY = 'locast_warm:samples'
+
+# Requests made to warm caches have this header, and aren't sampled
+WARM_HEADER = 'HTTP_X_LOCAST_WARM'
+
+# (url, language): [requests, computations, fill_ms], not yet flushed
+_samples = {}
+
+def sample_request(url, language = None, fill_ms = None):
+    '''
+    Records a sampled request of url, and the time it took to compute its
+    response if it was computed.
+    '''
+
+    with _stats_lock:
+        sample = _samples.setdefault((url, language), [0, 0, 0])
+        sample[0] += 1
+        if fill_ms is not None:
+            sample[1] += 1
+            sample[2] += fill_ms
+
+def _add_samples(totals, samples):
+    ''' Adds the samples of this process to totals, and returns them. '''
+
+    for key, counts in samples.items():
+        total = totals.setdefault(key, [0, 0, 0])
+        for i, count in enumerate(counts):
+            total[i] += count
+
+    max_urls = getattr(settings, 'API_CACHE_WARM_MAX_URLS', 1000)
+    if len(totals) > max_urls:
+        top = sorted(totals.items(), key = lambda item: item[1][0], reverse = True)[:max_urls]
+        totals = dict(top)
+
+    return totals
+
+def get_warm_samples(limit = None):
+    '''
+    Returns the most requested urls that were sampled, most requested first,
+    as a list of dictionaries of:
+
+        url, language
+            The url that was requested, and the language it was requested
+            in if the response depends on it (see cache_api_response)
+
+        requests
+            The number of sampled requests
+
+        fill_ms
+            The average number of milliseconds it took to compute the
+            response, or None if it wasn't computed in a sampled request
+
+    Arguments:
+
+        limit (optional)
+            The number of urls to return
+    '''
+
+    flush_stats()
+
+    totals = cache.get(WARM_SAMPLES_KEY) or {}
+    top = sorted(totals.items(), key = lambda item: item[1][0], reverse = True)[:limit]
+
+    samples = []
+    for (url, language), (requests, computations, fill_ms) in top:
+        samples.append({
+            'url': url,
+            'language': language,
+            'requests': requests,
+            'fill_ms': computations and float(fill_ms) / computations or None,
+        })
+
+    return samples
+
+# Parameters which are not part of a ruleset, but change the response
+KEY_PARAMS = ('callback',)
+
+def request_query(request, ignore_params = None, ruleset = None):
+    '''
+    Returns the query string of a request, as used in its cache key. See
+    request_cache_key.
+    '''
+
+    qd = request.GET.copy()
+
+    if ignore_params:
+        for param in ignore_params:
+            if param in qd:
+                del qd[param]
+
+    if ruleset is not None:
+        # qstranslate imports locast.api, which imports this
+        from locast.api.qstranslate import canonical_query
+        return canonical_query(ruleset, qd, extra_params = KEY_PARAMS)
+
+    return qd.urlencode()
+
+def request_cache_key(request, user_specific = False, ignore_params = None, ruleset = None, vary_language = False):
     '''
     Creates a cache key out of a request
 
@@ -52,18 +729,20 @@ def request_cache_key(request, user_specific = False, ignore_params = None):
         ignore_params (optional)
             Parameters to ignore when creating the url-based key
 
-        cache_group (optional)
-            The cache group that this value will belong to
-    '''
+        ruleset (optional)
+            A QueryTranslator ruleset. Only the parameters in the ruleset
+            (and special parameters) are used, in a canonical form (see
+            qstranslate.canonical_query), so that equivalent queries share a
+            key.
 
-    qd = request.GET.copy()
+        vary_language (optional)
+            Whether or not to take into account the language of the request
+    '''
 
-    if ignore_params:
-        for param in ignore_params:
-            if param in qd:
-                del qd[param]
+    key = request.path + request_query(request, ignore_params, ruleset)
 
-    key = request.path + qd.urlencode()
+    if vary_language:
+        key = key + '_' + translation.get_language()
 
     # If a user specific key is requested, create one
     if user_specific and request.user.is_authenticated():
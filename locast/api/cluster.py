@@ -0,0 +1,247 @@
+# Server side clustering of Locatable objects
+#
+# Rather than sending every point of a map, the points are snapped to a grid
+# and each cell of the grid is sent as a cluster:
+#
+#   { "location": [lon, lat], "count": 42, "ids": [1, 2, 3, 4, 5] }
+#
+# where location is the centroid of the points of the cell, and ids a sample
+# of API_CLUSTER_SAMPLE_SIZE (5) of them.
+#
+# At a given zoom level, the world is cut into 2^zoom by 2^zoom tiles (in
+# degrees, counted from -180, -90), and each tile into API_CLUSTER_GRID_SIZE
+# (8) by API_CLUSTER_GRID_SIZE cells. Clusters are cached for each tile, so
+# maps which are moved around reuse the tiles they have in common. The
+# clusters of the tiles that aren't cached are made by a single query, by
+# grid snapping in PostGIS, or by binning the points in python otherwise.
+
+import hashlib
+import math
+
+from django.conf import settings
+from django.contrib.gis.geos import Polygon
+from django.db import connections
+
+from locast.api import APIResponseOK, get_param, stable_repr
+from locast.api.cache import get_many_cache, set_many_cache
+from locast.api.exceptions import InvalidParameterException
+from locast.api.qstranslate import QueryTranslator, canonical_query, SPECIAL_PARAMS
+
+def _grid_size():
+    return getattr(settings, 'API_CLUSTER_GRID_SIZE', 8)
+
+def tile_size(zoom):
+    ''' The width and height of a tile at a zoom level, in degrees. '''
+
+    return 360.0 / 2 ** zoom, 180.0 / 2 ** zoom
+
+def get_tiles(bbox, zoom):
+    '''
+    Returns the range of tiles (x0, y0, x1, y1, inclusive) that cover a
+    bounding box (lon0, lat0, lon1, lat1) at a zoom level.
+    '''
+
+    width, height = tile_size(zoom)
+    last = 2 ** zoom - 1
+
+    def _tile(value, origin, size):
+        return min(max(int(math.floor((value - origin) / size)), 0), last)
+
+    return (_tile(bbox[0], -180, width), _tile(bbox[1], -90, height),
+            _tile(bbox[2], -180, width), _tile(bbox[3], -90, height))
+
+def get_clusters(objs, bbox, zoom, cache_key = None, cache_group = None, geometry_field = 'location'):
+    '''
+    Returns the clusters (see above) of the tiles which cover a bounding box.
+
+    Arguments:
+
+        objs
+            The QuerySet of objects to cluster
+
+        bbox
+            The bounding box of the map: (lon0, lat0, lon1, lat1)
+
+        zoom
+            The zoom level
+
+        cache_key (optional)
+            A key which identifies objs (i.e. its filters). Clusters are only
+            cached if it is given.
+
+        cache_group (optional)
+            The cache group of the clusters
+
+        geometry_field (optional)
+            The point field to cluster by
+    '''
+
+    x0, y0, x1, y1 = get_tiles(bbox, zoom)
+    if (x1 - x0 + 1) * (y1 - y0 + 1) > getattr(settings, 'API_CLUSTER_MAX_TILES', 64):
+        raise InvalidParameterException('Too many tiles, bbox is too large for the zoom level')
+
+    tiles = [(x, y) for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)]
+
+    found = {}
+    if cache_key:
+        keys = dict(('cluster:%s:%d:%d:%d' % (cache_key, zoom, x, y), (x, y)) for x, y in tiles)
+        found = dict((keys[key], clusters) for key, clusters in get_many_cache(keys.keys(), cache_group).items())
+
+    missing = [tile for tile in tiles if not tile in found]
+    if missing:
+        # One query for the tiles around all of the missing ones
+        computed = _cluster_tiles(objs, zoom, geometry_field,
+                min(x for x, y in missing), min(y for x, y in missing),
+                max(x for x, y in missing), max(y for x, y in missing))
+
+        for tile in missing:
+            found[tile] = computed.get(tile, [])
+
+        if cache_key:
+            set_many_cache(dict(('cluster:%s:%d:%d:%d' % (cache_key, zoom, x, y), found[(x, y)])
+                for x, y in missing), cache_group, timeout = getattr(settings, 'API_CLUSTER_CACHE_TIMEOUT', 60 * 60))
+
+    clusters = []
+    for tile in tiles:
+        clusters.extend(found[tile])
+
+    return clusters
+
+def _cluster_tiles(objs, zoom, geometry_field, x0, y0, x1, y1):
+    '''
+    Returns the clusters of a range of tiles, as a dictionary of
+    (x, y): [clusters].
+    '''
+
+    grid = _grid_size()
+    width, height = tile_size(zoom)
+    cell_width, cell_height = width / grid, height / grid
+
+    # Cells are counted from the corner of the first tile
+    lon0, lat0 = -180 + x0 * width, -90 + y0 * height
+    lon1, lat1 = -180 + (x1 + 1) * width, -90 + (y1 + 1) * height
+
+    objs = objs.filter(**{geometry_field + '__isnull': False,
+        geometry_field + '__bboverlaps': _bbox_polygon(lon0, lat0, lon1, lat1)})
+
+    if connections[objs.db].vendor == 'postgresql':
+        cells = _snap_sql(objs, geometry_field, lon0, lat0, lon1, lat1, cell_width, cell_height)
+    else:
+        cells = _snap_python(objs, geometry_field, lon0, lat0, lon1, lat1, cell_width, cell_height)
+
+    tiles = {}
+    for cx, cy, count, lon, lat, ids in cells:
+        tile = (x0 + int(cx) // grid, y0 + int(cy) // grid)
+        tiles.setdefault(tile, []).append({
+            'location': [lon, lat],
+            'count': count,
+            'ids': ids,
+        })
+
+    return tiles
+
+def _sample_size():
+    return getattr(settings, 'API_CLUSTER_SAMPLE_SIZE', 5)
+
+def _bbox_polygon(lon0, lat0, lon1, lat1):
+    poly = Polygon.from_bbox((lon0, lat0, lon1, lat1))
+    poly.set_srid(4326)
+    return poly
+
+def _snap_sql(objs, geometry_field, lon0, lat0, lon1, lat1, cell_width, cell_height):
+    ''' Grid snapping in PostGIS. Returns (cx, cy, count, lon, lat, ids) for each cell. '''
+
+    inner = objs.order_by().values_list('pk', geometry_field)
+    inner_sql, inner_params = inner.query.get_compiler(inner.db).as_sql()
+
+    # Points on the far edges belong to the next tiles
+    sql = '''SELECT floor((ST_X(t.geom) - %%s) / %%s) AS cx, floor((ST_Y(t.geom) - %%s) / %%s) AS cy,
+                    COUNT(*), AVG(ST_X(t.geom)), AVG(ST_Y(t.geom)), (array_agg(t.id))[1:%%s]
+             FROM (%s) AS t(id, geom)
+             WHERE ST_X(t.geom) >= %%s AND ST_X(t.geom) < %%s AND ST_Y(t.geom) >= %%s AND ST_Y(t.geom) < %%s
+             GROUP BY cx, cy''' % inner_sql
+
+    params = [lon0, cell_width, lat0, cell_height, _sample_size()] + list(inner_params) + [lon0, lon1, lat0, lat1]
+
+    cursor = connections[inner.db].cursor()
+    cursor.execute(sql, params)
+    return cursor.fetchall()
+
+def _snap_python(objs, geometry_field, lon0, lat0, lon1, lat1, cell_width, cell_height):
+    ''' Grid snapping in python, for other databases. See _snap_sql. '''
+
+    sample_size = _sample_size()
+
+    # (cx, cy): [count, sum of lon, sum of lat, ids]
+    cells = {}
+    for pk, point in objs.order_by().values_list('pk', geometry_field).iterator():
+        if not (lon0 <= point.x < lon1 and lat0 <= point.y < lat1):
+            continue
+
+        cell = (int((point.x - lon0) // cell_width), int((point.y - lat0) // cell_height))
+        c = cells.setdefault(cell, [0, 0.0, 0.0, []])
+        c[0] += 1
+        c[1] += point.x
+        c[2] += point.y
+        if len(c[3]) < sample_size:
+            c[3].append(pk)
+
+    return [(cx, cy, count, lon / count, lat / count, ids)
+            for (cx, cy), (count, lon, lat, ids) in cells.items()]
+
+def cluster_response(request, ctype, ruleset, base_query = None, cache_group = None,
+        geometry_field = 'location'):
+    '''
+    Returns an APIResponseOK of the clusters of the objects of ctype (see
+    get_clusters), for a view. The request has the usual QueryTranslator
+    filters, along with:
+
+        bbox
+            The bounding box of the map: lon0,lat0,lon1,lat1
+
+        zoom
+            The zoom level, from 0 to API_CLUSTER_MAX_ZOOM (20)
+
+    Arguments:
+
+        request
+            The request being answered
+
+        ctype, ruleset, base_query
+            See QueryTranslator
+
+        cache_group (optional)
+            The cache group of the clusters, which should be invalidated when
+            objects of ctype change (see register_cache_group)
+
+        geometry_field (optional)
+            The point field to cluster by
+    '''
+
+    qdict = request.GET.copy()
+
+    bbox = get_param(qdict, 'bbox')
+    zoom = get_param(qdict, 'zoom')
+    if not (bbox and zoom):
+        raise InvalidParameterException('bbox (lon0,lat0,lon1,lat1) and zoom are required')
+
+    try:
+        bbox = [float(v) for v in bbox.split(',')]
+        zoom = int(zoom)
+    except ValueError:
+        raise InvalidParameterException('Invalid bbox or zoom')
+
+    if len(bbox) != 4 or not (0 <= zoom <= getattr(settings, 'API_CLUSTER_MAX_ZOOM', 20)):
+        raise InvalidParameterException('Invalid bbox or zoom')
+
+    # Neither they, nor pagination, change the clusters
+    for param in ['bbox', 'zoom'] + SPECIAL_PARAMS:
+        if param in qdict:
+            del qdict[param]
+
+    objs = QueryTranslator(ctype, ruleset, base_query, request).filter(qdict)
+
+    cache_key = hashlib.md5('%s|%s|%s|%s|%d' % (ctype._meta.db_table, geometry_field, stable_repr(base_query),
+        canonical_query(ruleset, qdict), _grid_size())).hexdigest()
+
+    return APIResponseOK(content=get_clusters(objs, bbox, zoom, cache_key, cache_group, geometry_field))
@@ -0,0 +1,111 @@
+# Pluggable JSON encoding for the API.
+#
+# The codec is chosen with the API_JSON_CODEC setting, which can be 'json',
+# 'simplejson', or the dotted path to a class with dumps and loads methods.
+# Defaults to simplejson when it is installed (it's considerably faster with
+# its C speedups), otherwise the standard library json module.
+#
+# Dates, Decimals and GEOS geometries are encoded natively, so they don't
+# need to be formatted before being handed to the API responses.
+
+import datetime
+import decimal
+import json
+
+from django.conf import settings
+from django.contrib.gis.geos import GEOSGeometry
+from django.utils.functional import Promise
+from django.utils.importlib import import_module
+
+
+def _default(obj):
+    ''' Encodes the types json doesn't know about. '''
+
+    if isinstance(obj, datetime.datetime):
+        from locast.api import datetostr
+        return datetostr(obj)
+
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+
+    if isinstance(obj, GEOSGeometry):
+        if obj.geom_type == 'GeometryCollection':
+            return json.loads(obj.geojson)
+        return {'type': obj.geom_type, 'coordinates': obj.coords}
+
+    # Lazy translation strings
+    if isinstance(obj, Promise):
+        return unicode(obj)
+
+    raise TypeError(repr(obj) + ' is not JSON serializable')
+
+
+class JSONCodec(object):
+    ''' The standard library json module. '''
+
+    def dumps(self, obj):
+        return json.dumps(obj, default=_default)
+
+    def loads(self, s):
+        return json.loads(s)
+
+
+class SimpleJSONCodec(object):
+    ''' simplejson, which is a faster drop in for json. '''
+
+    def __init__(self):
+        import simplejson
+        self.simplejson = simplejson
+
+    def dumps(self, obj):
+        return self.simplejson.dumps(obj, default=_default)
+
+    def loads(self, s):
+        return self.simplejson.loads(s)
+
+
+CODECS = {
+    'json': JSONCodec,
+    'simplejson': SimpleJSONCodec,
+}
+
+_codec = None
+
+def get_codec():
+    ''' Returns the codec in use, creating it the first time. '''
+
+    global _codec
+    if _codec:
+        return _codec
+
+    name = getattr(settings, 'API_JSON_CODEC', None)
+
+    if not name:
+        try:
+            _codec = SimpleJSONCodec()
+        except ImportError:
+            _codec = JSONCodec()
+
+    elif name in CODECS:
+        _codec = CODECS[name]()
+
+    else:
+        module, cls = name.rsplit('.', 1)
+        _codec = getattr(import_module(module), cls)()
+
+    return _codec
+
+
+def dumps(obj):
+    ''' Encodes obj as a json string, using the current codec. '''
+
+    return get_codec().dumps(obj)
+
+
+def loads(s):
+    ''' Decodes a json string, using the current codec. Raises ValueError. '''
+
+    return get_codec().loads(s)
@@ -12,11 +12,9 @@ def get_comments(request, object, comment_id=None):
     comments = comment_model.objects.get_comments(object)
     comments, total, pg = paginate(comments, request.GET)
 
-    comment_arr=[]
-    for c in comments:
-        comment_arr.append(api_serialize(c))
+    comment_arr = api_serialize_many(comments)
 
-    return APIResponseOK(content=comment_arr, total=len(comment_arr), pg=pg)
+    return APIResponseOK(content=comment_arr, total=total, pg=pg)
 
 
 def post_comment(request, object):
@@ -1,5 +1,19 @@
-from django.http import HttpResponseNotAllowed
-from locast.api.cache import request_cache_key, get_cache, set_cache
+import calendar
+import hashlib
+import random
+import time
+from itertools import chain
+
+from django.conf import settings
+from django.db.models import Count, Max
+from django.db.models.query import QuerySet
+from django.http import HttpResponse, HttpResponseNotAllowed, HttpResponseNotModified
+from django.utils import translation
+from django.utils.http import http_date, parse_http_date_safe
+from locast.api import codec
+from locast.api.cache import request_cache_key, request_query, add_cache, delete_cache, get_cache, \
+        get_many_cache, set_cache, incr_stat, sample_request, WARM_HEADER
+from locast.api.profile import get_profile, start_profile, finish_profile
 
 def allow_method(method):
     ''' Only allow requests of a given method. '''
@@ -15,10 +29,37 @@ def allow_method(method):
         return _check_method
     return _check
 
-def cache_api_response(user_specific = False, ignore_params = None, cache_group = None):
+# Seconds between checks for a response that another request is computing
+LOCK_POLL_INTERVAL = 0.05
+
+# Seconds that a response which couldn't be cached (i.e. a 404) is computed
+# by every request, without waiting on the others
+UNCACHED_TTL = 60
+
+def cache_api_response(user_specific = False, ignore_params = None, cache_group = None,
+        stale_ttl = None, lock_timeout = 10, ruleset = None, vary_language = False):
     '''
     Cache a response to an API query 
 
+    Only the body, status, content type and Locast headers of the response
+    are cached, along with an ETag made from the body. Requests with a
+    matching If-None-Match get a 304 Not Modified, which only needs the
+    ETag to be fetched from the cache.
+
+    When a response is not in the cache (i.e. after incr_group) only one
+    request computes it. Concurrent requests for the same response wait for
+    it, or are given the previous response if stale_ttl allows it. The
+    number of recomputations that were avoided this way are counted in the
+    "coalesced_wait" and "coalesced_stale" statistics of the group (see
+    locast.api.cache.get_stats). If the request computing it fails, or its
+    response can't be cached (anything but a 200, or a streaming response),
+    the waiting requests compute it themselves as soon as it is done. The
+    requests of the next UNCACHED_TTL seconds then don't wait at all.
+
+    A sample of the requests is recorded for the cache_warm management
+    command (see locast.api.cache.sample_request), unless the response is
+    user specific.
+
     Arguments:
 
         user_specific (optional)
@@ -29,19 +70,111 @@ def cache_api_response(user_specific = False, ignore_params = None, cache_group
 
         cache_group (optional)
             The cache group that this value will belong to
+
+        ruleset (optional)
+            The QueryTranslator ruleset of the view, used to make a
+            canonical key (see request_cache_key)
+
+        vary_language (optional)
+            Whether or not to take into account the language of the request
+
+        stale_ttl (optional)
+            Number of seconds a response can be served for, after it was
+            computed, while a new one is being computed.
+
+        lock_timeout (optional)
+            The longest time in seconds a request will wait for another
+            request to compute the response, before computing it itself.
     '''
 
     def _cached_view(view_func):
 
         def _cache_response(request, *args, **kwargs):
-            key = request_cache_key(request, user_specific = user_specific, ignore_params = ignore_params)
-            cache = get_cache(key, cache_group = cache_group)
-            if cache:
-                return cache
+            # Profiled requests are always computed, see profile_api_response
+            if get_profile():
+                return view_func(request, *args, **kwargs)
 
-            resp = view_func(request, *args, **kwargs)
-            if resp.status_code == 200:
-                set_cache(key, resp, cache_group = cache_group)
+            key = request_cache_key(request, user_specific = user_specific, ignore_params = ignore_params,
+                    ruleset = ruleset, vary_language = vary_language)
+            etag_key = 'etag:' + key
+
+            sample = None
+            if not user_specific and _sampled(request):
+                sample = _sample(request, ignore_params, ruleset, vary_language)
+
+            # A client which has the response only needs the ETag, which is
+            # kept on its own so the body isn't loaded. Only the lookup of
+            # the entry counts in the hit and miss statistics, the others
+            # are bookkeeping.
+            if 'HTTP_IF_NONE_MATCH' in request.META:
+                etag = get_cache(etag_key, cache_group = cache_group, stats = False)
+                if etag and _etag_matches(request, etag):
+                    incr_stat(cache_group, 'hits')
+                    if sample:
+                        sample_request(*sample)
+                    return _not_modified({'etag': etag})
+
+            entry = get_cache(key, cache_group = cache_group)
+
+            # Entries cached as HttpResponse objects are ignored
+            if isinstance(entry, dict):
+                if sample:
+                    sample_request(*sample)
+                return _cached_response(request, entry)
+
+            lock_key = 'lock:' + key
+            uncached_key = 'uncached:' + key
+
+            # Nothing to wait for if the last response wasn't cached
+            locked = False
+            if not get_cache(uncached_key, cache_group = cache_group, stats = False):
+                locked = add_cache(lock_key, 1, cache_group = cache_group, timeout = lock_timeout)
+
+                if not locked:
+                    # Another request is computing the response
+                    if stale_ttl:
+                        entry = get_cache('stale:' + key, stats = False)
+                        if isinstance(entry, dict):
+                            incr_stat(cache_group, 'coalesced_stale')
+                            return _cached_response(request, entry)
+
+                    entry, released = _wait_for_entry(key, lock_key, cache_group, lock_timeout)
+                    if entry:
+                        incr_stat(cache_group, 'coalesced_wait')
+                        if sample:
+                            sample_request(*sample)
+                        return _cached_response(request, entry)
+
+                    if not released:
+                        incr_stat(cache_group, 'lock_timeout')
+
+            try:
+                started = time.time()
+                resp = view_func(request, *args, **kwargs)
+                fill_ms = int((time.time() - started) * 1000)
+                incr_stat(cache_group, 'recomputed')
+                incr_stat(cache_group, 'fill_ms', fill_ms)
+                if sample:
+                    sample_request(*sample, fill_ms = fill_ms)
+
+                # Streaming responses can only be sent once
+                if resp.status_code == 200 and not resp.streaming:
+                    entry = _cache_entry(resp)
+                    set_cache(key, entry, cache_group = cache_group)
+                    set_cache(etag_key, entry['etag'], cache_group = cache_group, stats = False)
+                    if stale_ttl:
+                        set_cache('stale:' + key, entry, timeout = stale_ttl, stats = False)
+
+                    resp['ETag'] = entry['etag']
+                    if _etag_matches(request, entry['etag']):
+                        return _not_modified(entry)
+
+                elif locked:
+                    set_cache(uncached_key, 1, cache_group = cache_group, timeout = UNCACHED_TTL, stats = False)
+
+            finally:
+                if locked:
+                    delete_cache(lock_key, cache_group = cache_group)
 
             return resp
 
@@ -49,6 +182,218 @@ def cache_api_response(user_specific = False, ignore_params = None, cache_group
  
     return _cached_view
 
+def _sampled(request):
+    if WARM_HEADER in request.META:
+        return False
+
+    return random.random() < getattr(settings, 'API_CACHE_WARM_SAMPLE_RATE', 0.01)
+
+def _sample(request, ignore_params, ruleset, vary_language):
+    ''' The url and language that a request can be made again with. '''
+
+    url = request.path
+    query = request_query(request, ignore_params, ruleset)
+    if query:
+        url = url + '?' + query
+
+    language = None
+    if vary_language:
+        language = translation.get_language()
+
+    return url, language
+
+def _wait_for_entry(key, lock_key, cache_group, timeout):
+    '''
+    Polls the cache for an entry, for up to timeout seconds or until the
+    lock is released. Returns a tuple of (entry or None, whether the lock
+    was released).
+    '''
+
+    waited = 0
+    while waited < timeout:
+        time.sleep(LOCK_POLL_INTERVAL)
+        waited += LOCK_POLL_INTERVAL
+
+        found = get_many_cache([key, lock_key], cache_group = cache_group, stats = False)
+        entry = found.get(key)
+        if isinstance(entry, dict):
+            return entry, True
+
+        # Released without caching anything
+        if found.get(lock_key) is None:
+            return None, True
+
+    return None, False
+
+# Headers kept along with a cached response
+CACHED_HEADERS = ('Location', 'Content-Language')
+
+def _cache_entry(resp):
+    ''' What is cached for a response. '''
+
+    headers = {}
+    for header, value in resp.items():
+        if header.startswith('X-') or header in CACHED_HEADERS:
+            headers[header] = value
+
+    content = resp.content
+
+    return {
+        'content': content,
+        'status': resp.status_code,
+        'content_type': resp['Content-Type'],
+        'headers': headers,
+        'etag': '"%s"' % hashlib.md5(content).hexdigest(),
+    }
+
+def _cached_response(request, entry):
+    ''' Rebuilds a response from a cache entry, or a 304 if the client has it. '''
+
+    if _etag_matches(request, entry['etag']):
+        return _not_modified(entry)
+
+    resp = HttpResponse(entry['content'], status=entry['status'], content_type=entry['content_type'])
+    for header, value in entry['headers'].items():
+        resp[header] = value
+    resp['ETag'] = entry['etag']
+
+    return resp
+
+def _not_modified(entry):
+    resp = HttpResponseNotModified()
+    resp['ETag'] = entry['etag']
+    return resp
+
+def _etag_matches(request, etag):
+    ''' Checks the If-None-Match header of a request against an ETag. '''
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', None)
+    if not if_none_match:
+        return False
+
+    etags = [e.strip() for e in if_none_match.split(',')]
+    return (etag in etags) or ('*' in etags)
+
+def conditional_api_response(objs_func):
+    '''
+    Answers conditional GET requests (If-None-Match, If-Modified-Since)
+    with a 304 Not Modified, before the view serializes anything, using the
+    modified dates of Syncable objects.
+
+    objs_func(request, *args, **kwargs) is called with the arguments of the
+    view, and returns what the response is made of: a single object, or a
+    filtered QuerySet (i.e. from QueryTranslator.filter, before paginate).
+    A QuerySet is checked with one aggregate query, of the latest modified
+    date and the number of objects (which changes when one is deleted).
+    The response then gets a Last-Modified header and a weak ETag, which
+    includes the query string (so each page has its own) and the user.
+
+    Changes that don't update modified, such as favorites, aren't seen. 
+    For a QuerySet, only If-None-Match is used, as a date alone misses
+    deletions. Use it outside of cache_api_response.
+
+    Usage:
+
+    @conditional_api_response(lambda request: QueryTranslator(Cast, ruleset).filter(request.GET))
+    def get_casts(request):
+        ...
+    '''
+
+    def _conditional_view(view_func):
+
+        def _conditional_response(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view_func(request, *args, **kwargs)
+
+            objs = objs_func(request, *args, **kwargs)
+            modified, count = _get_modified(objs)
+            etag = _modified_etag(request, modified, count)
+
+            if _etag_matches(request, etag):
+                return _not_modified({'etag': etag})
+
+            # Only an object's date is enough
+            if modified and count is None and not 'HTTP_IF_NONE_MATCH' in request.META:
+                since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+                if since and since >= calendar.timegm(modified.utctimetuple()):
+                    return _not_modified({'etag': etag})
+
+            resp = view_func(request, *args, **kwargs)
+
+            if resp.status_code == 200:
+                resp['ETag'] = etag
+                if modified:
+                    resp['Last-Modified'] = http_date(calendar.timegm(modified.utctimetuple()))
+
+            return resp
+
+        return _conditional_response
+
+    return _conditional_view
+
+def _get_modified(objs):
+    '''
+    Returns the latest modified date of objs and the number of objects, or
+    the modified date of a single object and None.
+    '''
+
+    # Cached results, see QueryTranslator
+    if hasattr(objs, 'ids') and hasattr(objs, 'queryset'):
+        objs = objs.queryset.filter(pk__in = objs.ids)
+
+    if not isinstance(objs, QuerySet):
+        return objs.modified, None
+
+    result = objs.order_by().aggregate(modified = Max('modified'), count = Count('pk', distinct = True))
+    return result['modified'], result['count']
+
+def _modified_etag(request, modified, count):
+    user = request.user.is_authenticated() and request.user.id or ''
+    modified = modified and modified.isoformat() or ''
+
+    return 'W/"%s"' % hashlib.md5('%s|%s|%s|%s' % (request.get_full_path(), user, modified, count)).hexdigest()
+
+# Request parameter and header which ask for a profile
+PROFILE_PARAM = '_profile'
+PROFILE_HEADER = 'HTTP_X_LOCAST_PROFILE'
+
+def profile_api_response(view_func):
+    '''
+    Lets staff profile a view (see locast.api.profile) by adding a _profile
+    parameter or an X-Locast-Profile header to a request. A json response
+    is then wrapped along with the profile:
+
+    { "response": ..., "debug": { "timings_ms": ..., "queries": ... } }
+
+    Other responses (i.e. streaming ones) get a summary of the timings in
+    an X-Locast-Profile header. The response isn't taken from the cache
+    (see cache_api_response). Use it outside of the other decorators.
+    '''
+
+    def _profile_response(request, *args, **kwargs):
+        if not (PROFILE_PARAM in request.GET or PROFILE_HEADER in request.META):
+            return view_func(request, *args, **kwargs)
+
+        if not request.user.is_staff:
+            return view_func(request, *args, **kwargs)
+
+        start_profile()
+        try:
+            resp = view_func(request, *args, **kwargs)
+        finally:
+            profile = finish_profile()
+
+        debug = profile.as_dict()
+
+        if not resp.streaming and resp.get('Content-Type', '').startswith('application/json'):
+            resp.content = codec.dumps({'response': codec.loads(resp.content), 'debug': debug})
+        else:
+            resp['X-Locast-Profile'] = codec.dumps(debug['timings_ms'])
+
+        return resp
+
+    return _profile_response
+
 # Based on https://gist.github.com/sivy/871954
 def jsonp_support(callback_param='callback'):
     '''
@@ -85,7 +430,10 @@ def jsonp_support(callback_param='callback'):
 
             if callback:
                 resp['Content-Type']='text/javascript; charset=utf-8'
-                resp.content = u'%s(%s)' % (callback, resp.content)
+                if resp.streaming:
+                    resp.streaming_content = chain([u'%s(' % callback], resp.streaming_content, [u')'])
+                else:
+                    resp.content = u'%s(%s)' % (callback, resp.content)
                 return resp
             else:
                 return resp                
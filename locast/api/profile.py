@@ -0,0 +1,146 @@
+# Profiling of API requests
+#
+# Staff can add a _profile parameter (or an X-Locast-Profile header) to a
+# request to a view wrapped with profile_api_response (see decorators).
+# While the view runs, a Profile is kept for the thread, which records:
+#
+#   - the SQL compiled by QueryTranslator.filter, with its EXPLAIN ANALYZE
+#     (PostgreSQL only), and the time spent translating the query
+#   - every query run, their number and the time spent running them
+#   - the time spent serializing (api_serialize_many) and encoding
+#     (APIResponseOK) the response
+#
+# When no request is profiled, the hooks only check get_profile().
+
+import threading
+import time
+
+from django.db import connections
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils.encoding import smart_text
+
+_local = threading.local()
+
+def get_profile():
+    ''' Returns the Profile of the request being answered, or None. '''
+
+    return getattr(_local, 'profile', None)
+
+def start_profile():
+    _local.profile = Profile()
+    return _local.profile
+
+def finish_profile():
+    ''' Stops and returns the Profile of the request being answered. '''
+
+    profile = get_profile()
+    _local.profile = None
+    if profile:
+        profile.finish()
+    return profile
+
+def start_timer(name):
+    profile = get_profile()
+    if profile:
+        profile.start(name)
+
+def stop_timer(name):
+    profile = get_profile()
+    if profile:
+        profile.stop(name)
+
+class Profile(object):
+    '''
+    What is recorded while a request is profiled. Queries are recorded by
+    using the debug cursor on every connection (as with DEBUG = True).
+    '''
+
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+
+        # name: seconds
+        self.timings = {}
+
+        # name: [depth, time started], for the timers that are running
+        self._running = {}
+
+        self.translated = []
+
+        # alias: (connection, use_debug_cursor, number of queries before)
+        self._connections = {}
+        for alias in connections:
+            connection = connections[alias]
+            self._connections[alias] = (connection, connection.use_debug_cursor, len(connection.queries))
+            connection.use_debug_cursor = True
+
+        self.queries = []
+
+    def start(self, name):
+        # Only the outermost of nested timers counts
+        running = self._running.setdefault(name, [0, None])
+        if running[0] == 0:
+            running[1] = time.time()
+        running[0] += 1
+
+    def stop(self, name):
+        running = self._running.get(name, None)
+        if not running or running[0] == 0:
+            return
+
+        running[0] -= 1
+        if running[0] == 0:
+            self.timings[name] = self.timings.get(name, 0) + time.time() - running[1]
+
+    def add_time(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0) + seconds
+
+    def add_queryset(self, name, objs):
+        '''
+        Records the SQL of a QuerySet, and how PostgreSQL runs it.
+        '''
+
+        try:
+            sql, params = objs.query.get_compiler(objs.db).as_sql()
+        except EmptyResultSet:
+            self.translated.append({'name': name, 'sql': None})
+            return
+
+        explain = None
+        connection = connections[objs.db]
+        if connection.vendor == 'postgresql':
+            cursor = connection.cursor()
+            cursor.execute('EXPLAIN ANALYZE ' + sql, params)
+            explain = [row[0] for row in cursor.fetchall()]
+
+        self.translated.append({
+            'name': name,
+            'sql': sql,
+            'params': [smart_text(p) for p in params],
+            'explain': explain,
+        })
+
+    def finish(self):
+        self.finished = time.time()
+
+        for alias, (connection, use_debug_cursor, before) in self._connections.items():
+            for query in connection.queries[before:]:
+                # EXPLAIN ANALYZE runs the query, leave those out
+                if query['sql'].startswith('EXPLAIN ANALYZE '):
+                    continue
+                self.queries.append({'db': alias, 'sql': query['sql'], 'time': float(query['time'])})
+            connection.use_debug_cursor = use_debug_cursor
+
+    def as_dict(self):
+        finished = self.finished or time.time()
+
+        timings = dict((name, round(seconds * 1000, 3)) for name, seconds in self.timings.items())
+        timings['execution'] = round(sum(q['time'] for q in self.queries) * 1000, 3)
+        timings['total'] = round((finished - self.started) * 1000, 3)
+
+        return {
+            'timings_ms': timings,
+            'query_count': len(self.queries),
+            'queries': self.queries,
+            'translated': self.translated,
+        }
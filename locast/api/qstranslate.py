@@ -1,14 +1,24 @@
+import hashlib
+import math
+import re
+import urllib
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, ValidationError
+from django.db import connections
 from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.sql.datastructures import EmptyResultSet
 
 from django.contrib.gis.geos import Point, Polygon
 from django.contrib.gis.measure import D
 
-from locast.api import strtodate
+from locast.api import api_prefetch, stable_repr, strtodate
+from locast.api.cache import get_cache, set_cache
 from locast.api.exceptions import InvalidParameterException
+from locast.api.profile import get_profile, start_timer, stop_timer
 
-# TODO: * multiple ORDER BY support
-#       * OR support?
-#       * Make ruleset dicts into named tuples to be consistent with django
+# TODO: * Make ruleset dicts into named tuples to be consistent with django
 
 # example_ruleset = {
 #    'author'        :    { 'type' : 'string', 'alias' : 'author__username' },
@@ -25,12 +35,565 @@ from locast.api.exceptions import InvalidParameterException
 #
 # i.e. ?author=username&date__lte=20091002 will result in 
 # models.objects.filter(Q(author=username) & Q(date__lte = 20091002))
+#
+# Lists (i.e. ?tags=a,b,~c) match objects which have all of the items, and
+# none of the negated ones. ?tags__any=a,b matches objects with any of them.
+# ?orderby=-modified,title orders by more than one field.
 
 # Available types: string, int, list, geo_distance, geo_polygon,
 
+# Parameters which are not filters, but are used by the API (see paginate,
+# paginate_cursor, get_total, api_serialize)
+SPECIAL_PARAMS = ['orderby', 'page', 'pagesize', 'fields', 'exclude', 'cursor', 'count']
+
+def canonical_query(ruleset, qdict, extra_params = ()):
+    '''
+    Returns a canonical url encoded query string for a query dictionary,
+    which is the same for all queries that will give the same results: 
+    parameters that aren't in the ruleset (or special) are left out, the
+    rest are sorted, and values are normalized by type (list items are
+    sorted, coordinates rounded to API_CACHE_COORD_PRECISION places).
+    Used to make cache keys. Values are normalized the same way the parsers
+    read them (see split_list and round_coords), so two queries only share
+    a canonical form if they filter on the same values.
+
+    Arguments:
+
+        ruleset
+            The ruleset dictionary
+
+        qdict
+            The query dictionary (a la django request.GET)
+
+        extra_params
+            Other parameters to keep, as is
+    '''
+
+    params = []
+    for k in qdict.keys():
+        value = qdict.get(k)
+        field = k.split('__', 1)[0]
+
+        if k in ('fields', 'exclude'):
+            value = _normalize_list(value)
+
+        elif k in SPECIAL_PARAMS or k in extra_params:
+            pass
+
+        elif field in ruleset:
+            value = _normalize_value(ruleset[field]['type'], value)
+
+        else:
+            continue
+
+        params.append((k.encode('utf-8'), unicode(value).encode('utf-8')))
+
+    params.sort()
+    return urllib.urlencode(params)
+
+def split_list(value):
+    ''' The items of a comma separated list parameter, stripped, without blanks. '''
+
+    return [v.strip() for v in value.split(',') if v.strip()]
+
+def _normalize_list(value):
+    return ','.join(sorted(set(split_list(value))))
+
+def _normalize_coords(values):
+    precision = getattr(settings, 'API_CACHE_COORD_PRECISION', 6)
+    return ['%.*f' % (precision, float(v)) for v in values]
+
+def round_coords(values):
+    ''' Coordinates as floats, rounded to API_CACHE_COORD_PRECISION places. '''
+
+    return [float(v) for v in _normalize_coords(values)]
+
+def _normalize_value(type, value):
+    try:
+        if type == 'list':
+            return _normalize_list(value)
+
+        elif type == 'int':
+            return str(int(value))
+
+        elif type == 'bool':
+            return str(value.lower() == 'true').lower()
+
+        elif type == 'geo_polygon':
+            return ','.join(_normalize_coords(value.split(',')))
+
+        elif type == 'geo_distance':
+            values = value.split(',')
+            return ','.join(_normalize_coords(values[:2]) + values[2:])
+
+    # Invalid values are rejected by the translator, leave them be
+    except ValueError:
+        pass
+
+    return value
+
+# Modifiers (lookups) known for each type. Any modifier (i.e. __in,
+# __isnull, or a relation like author__username) is passed on to the ORM,
+# unless a ruleset entry restricts them with a 'modifiers' list of known
+# ones, i.e.
+#
+#    'title'         :    { 'type' : 'string', 'modifiers' : ('', 'icontains') },
+#
+# '' is the field itself.
+
+STRING_MODIFIERS = ('', 'exact', 'iexact', 'contains', 'icontains', 'startswith', 'istartswith',
+        'endswith', 'iendswith')
+
+MODIFIERS = {
+    'string': STRING_MODIFIERS,
+    'int': ('', 'exact', 'gt', 'gte', 'lt', 'lte'),
+    'bool': ('', 'exact'),
+    'datetime': ('', 'exact', 'gt', 'gte', 'lt', 'lte'),
+    'list': ('', 'exact', 'iexact', 'any'),
+    'geo_distance': ('', 'distance_lt', 'distance_lte', 'distance_gt', 'distance_gte', 'dwithin'),
+    'geo_polygon': ('', 'within', 'contained', 'intersects', 'overlaps', 'bboverlaps', 'contains',
+        'bbcontains', 'coveredby', 'covers', 'disjoint'),
+}
+
+class ParamParser(object):
+    '''
+    A compiled ruleset entry, which turns the value of a query parameter
+    into a python value (coerce) and a Q object (query). Types without a
+    parser of their own are used as they are.
+
+    Arguments:
+
+        name
+            The name of the parameter
+
+        rule
+            The ruleset entry
+    '''
+
+    type = None
+
+    # Whether the parameter holds more than one value (see QueryTranslator)
+    multi_valued = False
+
+    def __init__(self, name, rule):
+        self.name = name
+        self.path = str(rule.get('alias', name))
+
+        # None allows any modifier
+        self.modifiers = None
+
+        if 'modifiers' in rule:
+            known = MODIFIERS.get(self.type, STRING_MODIFIERS)
+            unknown = set(rule['modifiers']) - set(known)
+            if unknown:
+                raise ImproperlyConfigured('Unknown modifiers for %s: %s' % (name, ', '.join(sorted(unknown))))
+
+            self.modifiers = frozenset(rule['modifiers'])
+
+    def allows(self, modifier):
+        return self.modifiers is None or modifier in self.modifiers
+
+    def lookup(self, modifier):
+        ''' The ORM lookup for a modifier, or None if it isn't allowed. '''
+
+        if not self.allows(modifier):
+            return None
+
+        if modifier:
+            return self.path + '__' + str(modifier)
+
+        return self.path
+
+    def coerce(self, value):
+        return value
+
+    def query(self, lookup, value):
+        return Q(**{lookup:value})
+
+class StringParser(ParamParser):
+    type = 'string'
+
+    def query(self, lookup, value):
+        # Deal with negation
+        if len(value) > 1 and value[0] == '~':
+            return ~Q(**{lookup:value[1:]})
+
+        return Q(**{lookup:value})
+
+class IntParser(ParamParser):
+    type = 'int'
+
+    def coerce(self, value):
+        return int(value)
+
+class BoolParser(ParamParser):
+    type = 'bool'
+
+    def coerce(self, value):
+        return value.lower() == 'true'
+
+class DateTimeParser(ParamParser):
+    type = 'datetime'
+
+    def coerce(self, value):
+        return strtodate(value)
+
+class ListParser(StringParser):
+    '''
+    Each item of the list is a string query, all of which must match, or any
+    of which with the "any" modifier. Negated items (~item) must not match
+    either way.
+    '''
+
+    type = 'list'
+    multi_valued = True
+
+    def lookup(self, modifier):
+        if modifier == 'any' and self.allows(modifier):
+            return self.path + '__in'
+
+        return super(ListParser, self).lookup(modifier)
+
+    def coerce(self, value):
+        return split_list(value)
+
+    def filter(self, objs, lookup, values):
+        '''
+        Filters a QuerySet by the items of a list. Returns the new QuerySet,
+        and whether a multi valued join was added to it.
+        '''
+
+        any_of = lookup.endswith('__in')
+        if any_of:
+            lookup = lookup[:-len('__in')]
+
+        items = set()
+        for value in values:
+            # Negated items are a subquery, not a join
+            if len(value) > 1 and value[0] == '~':
+                objs = objs.filter(self.query(lookup, value))
+            else:
+                items.add(value)
+
+        if not items:
+            return objs, False
+
+        if any_of:
+            return objs.filter(**{lookup + '__in':items}), True
+
+        # All of the items of a many to many field can be found in one
+        # subquery of the through table, rather than a join for each.
+        field = _m2m_field(objs.model, lookup)
+        if field:
+            return _filter_m2m_all(objs, field, items), False
+
+        # Unfortunately, in order to AND together other lists, we have to
+        # chain filters after the QuerySet.
+        #
+        # Q(tags=tag1) & Q(tags=tag2) does not work.
+        # self.ctype.objects.filter(tags=tag1).filter(tags=tag2)... does work
+        for item in items:
+            objs = objs.filter(self.query(lookup, item))
+
+        return objs, True
+
+# Lookups on a geometry field which can only match within its bounding box
+BBOX_LOOKUPS = ('within', 'contained', 'intersects', 'overlaps', 'contains', 'bbcontains',
+        'coveredby', 'covers', 'distance_lt', 'distance_lte', 'dwithin')
+
+def _geometry_path(lookup):
+    '''
+    Returns the geometry field of a lookup (i.e. location for
+    location__within), or None if it doesn't have a lookup that a bounding
+    box can narrow down.
+    '''
+
+    path, sep, term = lookup.rpartition('__')
+    if path and term in BBOX_LOOKUPS:
+        return path
+
+    return None
+
+def _bbox_query(path, bbox):
+    poly = Polygon.from_bbox(bbox)
+    poly.set_srid(4326)
+    return Q(**{path + '__bboverlaps':poly})
+
+# i.e. 100, 100m, 2.5km, 3mi
+DISTANCE_RE = re.compile(r'^\s*([0-9]*\.?[0-9]+)\s*(m|km|mi)?\s*$')
+
+# Meters in a degree of latitude, and a margin for the spheroid
+METERS_PER_DEGREE = 111195.0
+BBOX_MARGIN = 1.01
+
+class GeoDistanceParser(ParamParser):
+    '''
+    lon,lat,distance where distance is in meters, unless it has a unit:
+    m, km or mi (i.e. -71.09,42.36,2.5km)
+
+    The dwithin modifier only takes degrees on geographic (4326) columns, so
+    it is made into distance_lte, which takes the distance as it is.
+    '''
+
+    type = 'geo_distance'
+
+    def coerce(self, value):
+        # The value should be a tuple like this: (point, distance)
+        # where point is a Point object and distance a Distance object
+
+        dist = value.split(',')
+        if len(dist) != 3:
+            raise ValueError('Invalid distance: ' + value)
+
+        pnt = Point(*round_coords(dist[:2]))
+
+        match = DISTANCE_RE.match(dist[2])
+        if not match:
+            raise ValueError('Invalid distance: ' + dist[2])
+
+        return (pnt, D(**{str(match.group(2) or 'm'):float(match.group(1))}))
+
+    def query(self, lookup, value):
+        pnt, dist = value
+        if lookup.endswith('__dwithin'):
+            lookup = lookup[:-len('dwithin')] + 'distance_lte'
+
+        q = Q(**{lookup:value})
+
+        # The exact distance is computed for each row, so the geometries
+        # are narrowed down with the (indexed) bounding box of the circle
+        # first. Not across the antimeridian or the poles.
+        path = _geometry_path(lookup)
+        if not path:
+            return q
+
+        dlat = dist.m / METERS_PER_DEGREE * BBOX_MARGIN
+        if abs(pnt.y) + dlat >= 90:
+            return q
+
+        dlon = dlat / math.cos(math.radians(abs(pnt.y) + dlat))
+        if abs(pnt.x) + dlon >= 180:
+            return q
+
+        return _bbox_query(path, (pnt.x - dlon, pnt.y - dlat, pnt.x + dlon, pnt.y + dlat)) & q
+
+class GeoPolygonParser(ParamParser):
+    type = 'geo_polygon'
+
+    def query(self, lookup, value):
+        q = Q(**{lookup:value})
+
+        # The && operator uses the index, before the exact test
+        path = _geometry_path(lookup)
+        if path:
+            return _bbox_query(path, value.extent) & q
+
+        return q
+
+    def coerce(self, value):
+        pnts = value.split(',')
+        bbox = tuple(round_coords(pnts[:4]))
+        if len(bbox) != 4:
+            raise ValueError('Invalid polygon: ' + value)
+
+        poly = Polygon.from_bbox(bbox)
+        # TODO: 4326 - this should be a setting?
+        poly.set_srid(4326)
+
+        return poly
+
+PARSERS = dict((parser.type, parser) for parser in (StringParser, IntParser, BoolParser,
+    DateTimeParser, ListParser, GeoDistanceParser, GeoPolygonParser))
+
+class CompiledRuleset(object):
+    '''
+    A ruleset compiled into a parser for each field (see compile_ruleset).
+    Unknown modifiers in the ruleset raise ImproperlyConfigured.
+    '''
+
+    def __init__(self, ruleset):
+        self.parsers = {}
+        for name, rule in ruleset.items():
+            self.parsers[name] = PARSERS.get(rule['type'], ParamParser)(name, rule)
+
+        # query parameter: (parser, lookup), for the parameters seen so far
+        # with a known modifier. Others are up to the client, and aren't
+        # kept.
+        self._params = {}
+
+    def param(self, key):
+        '''
+        Returns the parser and ORM lookup of a query parameter (i.e.
+        author__contains), or None if it isn't in the ruleset. Raises
+        InvalidParameterException if the modifier isn't allowed.
+        '''
+
+        try:
+            return self._params[key]
+        except KeyError:
+            pass
+
+        name, sep, modifier = key.partition('__')
+        parser = self.parsers.get(name, None)
+        if not parser:
+            return None
+
+        lookup = parser.lookup(modifier)
+        if not lookup:
+            raise InvalidParameterException('Invalid modifier: ' + key)
+
+        if modifier in MODIFIERS.get(parser.type, STRING_MODIFIERS):
+            self._params[key] = (parser, lookup)
+
+        return (parser, lookup)
+
+    def order_by(self, orderby):
+        '''
+        Returns the ORM ordering (a list) for an orderby parameter, i.e.
+        -modified,title
+        '''
+
+        ordering = []
+        for item in orderby.split(','):
+            field = item.strip().lstrip('-')
+            if not field in self.parsers:
+                raise InvalidParameterException('Invalid orderby field: ' + item)
+
+            path = self.parsers[field].path
+            if item.strip().startswith('-'):
+                path = '-' + path
+
+            ordering.append(path)
+
+        return ordering
+
+# (model, lookup): whether it goes through a multi valued relation. Lookups
+# are partly up to the client, so only the first MULTI_VALUED_MAX are kept.
+_multi_valued = {}
+MULTI_VALUED_MAX = 1000
+
+def _is_multi_valued(model, lookup):
+    '''
+    Whether a lookup (i.e. tags__name__contains) goes through a many to
+    many or reverse foreign key relation.
+    '''
+
+    key = (model, lookup)
+    try:
+        return _multi_valued[key]
+    except KeyError:
+        pass
+
+    multi = False
+    for name in lookup.split('__'):
+        try:
+            field, m, direct, m2m = model._meta.get_field_by_name(name)
+        except FieldDoesNotExist:
+            # A lookup term, or pk
+            break
+
+        if m2m or not direct:
+            multi = True
+            break
+
+        if not field.rel:
+            break
+
+        model = field.rel.to
+
+    if len(_multi_valued) < MULTI_VALUED_MAX:
+        _multi_valued[key] = multi
+
+    return multi
+
+def _q_lookups(q):
+    ''' The lookups of a Q object, and of the Q objects in it. '''
+
+    for child in q.children:
+        if isinstance(child, Q):
+            for lookup in _q_lookups(child):
+                yield lookup
+        else:
+            yield child[0]
+
+def _m2m_field(model, lookup):
+    '''
+    Returns the many to many field of model that a lookup matches the
+    primary keys of (i.e. tags, tags__exact, tags__name if name is the
+    primary key of Tag), or None.
+    '''
+
+    name, sep, rest = lookup.partition('__')
+    try:
+        field, m, direct, m2m = model._meta.get_field_by_name(name)
+    except FieldDoesNotExist:
+        return None
+
+    if not (direct and m2m):
+        return None
+
+    pk_name = field.rel.to._meta.pk.name
+    if not rest in ('', 'exact', 'pk', 'pk__exact', pk_name, pk_name + '__exact'):
+        return None
+
+    return field
+
+def _filter_m2m_all(objs, field, items):
+    '''
+    Filters a QuerySet to the objects related to all of items (primary keys
+    of the related model) through a many to many field, with a single
+    subquery:
+
+    pk IN (SELECT source FROM through WHERE target IN (items)
+           GROUP BY source HAVING COUNT(DISTINCT target) = len(items))
+    '''
+
+    qn = connections[objs.db].ops.quote_name
+    model = objs.model
+    target_pk = field.rel.to._meta.pk
+
+    try:
+        items = [target_pk.get_prep_value(target_pk.to_python(item)) for item in items]
+    except ValidationError, e:
+        raise InvalidParameterException(', '.join(e.messages))
+
+    source = qn(field.m2m_column_name())
+    target = qn(field.m2m_reverse_name())
+
+    where = '%s.%s IN (SELECT %s FROM %s WHERE %s IN (%s) GROUP BY %s HAVING COUNT(DISTINCT %s) = %%s)' % (
+        qn(model._meta.db_table), qn(model._meta.pk.column), source,
+        qn(field.rel.through._meta.db_table), target, ', '.join(['%s'] * len(items)),
+        source, target)
+
+    return objs.extra(where = [where], params = items + [len(items)])
+
+# id(ruleset): (ruleset, CompiledRuleset)
+_compiled_rulesets = {}
+
+def compile_ruleset(ruleset):
+    '''
+    Returns the compiled form of a ruleset, which is compiled once.
+    Rulesets are expected not to change once they are used.
+    '''
+
+    entry = _compiled_rulesets.get(id(ruleset), None)
+    if not entry or entry[0] is not ruleset:
+        # Rulesets made for each request shouldn't pile up
+        if len(_compiled_rulesets) > 1000:
+            _compiled_rulesets.clear()
+
+        entry = (ruleset, CompiledRuleset(ruleset))
+        _compiled_rulesets[id(ruleset)] = entry
+
+    return entry[1]
+
+# Cached in place of the ids of a query with too many results. A string,
+# which every cache backend gives back as it was set.
+TOO_MANY_RESULTS = 'too many results'
+
 class QueryTranslator:
 
-    def __init__(self, ctype, ruleset, base_query = None, request = None):
+    def __init__(self, ctype, ruleset, base_query = None, request = None, cache_group = None):
         '''
         Create a new QueryTranslator
 
@@ -41,210 +604,190 @@ class QueryTranslator:
 
             ruleset
                 A rulset dictionary defining which parameters are
-                queryable and what type they are. See above.
+                queryable and what type they are. See above. It is
+                compiled the first time it is used (see compile_ruleset).
 
             base_query
                 A Q object that is a query to seed the translator with.
-                It will be run before anything passed in through a 
+                It will be run before anything passed in through a
                 query string.
+
+            request
+                The request being answered. Used to prepare the objects
+                loaded from cached results (see ResultIds).
+
+            cache_group
+                If given, the ids of the results of each query are cached
+                in this cache group (which should be invalidated when the
+                model changes, see register_cache_group), and filter
+                returns a ResultIds rather than a QuerySet.
         '''
 
         self.ctype = ctype
         self.ruleset = ruleset
+        self.compiled = compile_ruleset(ruleset)
         self.base_query = base_query
         self.request = request
+        self.cache_group = cache_group
 
     def filter(self, qdict):
         '''
         Run the filter based on a query dictionary passed in (request.GET or request.POST)
 
         Arguments:
-            
+
             qdict
                 The query dictionary (a la django request.GET or request.POST)
         '''
 
+        start_timer('translation')
+
+        compiled = self.compiled
         q = Q()
-        # Create a copy so qdict is mutable, and so it doesn't destroy it if it is already mutable
-        qdict = qdict.copy()
+        orderby = None
+
+        # Whether the query joins a multi valued relation, which can return
+        # an object more than once
+        multi_join = False
 
-        special_params = self.__extract_special_params(qdict, ['orderby','page','pagesize'])
+        # Multi valued parameters, which are taken into account afterwards
+        lists = []
 
-        # Pagesize can just be used as a limiter to the number of objects to return.
-        # Page should just default to 1
-        if ('pagesize' in special_params) and (not 'page' in special_params):
-            special_params['page'] = '1'
+        for key in qdict.keys():
+            value = qdict.get(key)
 
-        try:
-            self.__sanitize(qdict)
-        except ValueError, e:
-            raise InvalidParameterException(e.message)
+            if key in SPECIAL_PARAMS:
+                if key == 'orderby' and value:
+                    orderby = value
+                continue
 
-        # Used to keep track of the values that are lists
-        # these are taken into account afterwards
-        lists = []
-        
-        for raw_field, value in qdict.items():
+            param = compiled.param(key)
+            if not param:
+                continue
 
-            # Deal with a list of items.
-            # if len(value) > 1:
-            f, m = self.__get_field(raw_field)
-            type = self.ruleset[f]['type']
-            if type == 'list':
-                lists.append({raw_field:value})
+            parser, lookup = param
+            try:
+                value = parser.coerce(value)
+            except ValueError, e:
+                raise InvalidParameterException(e.message)
 
-            # A single item
+            if parser.multi_valued:
+                lists.append((parser, lookup, value))
             else:
-                q = q & self.__get_query_obj(raw_field,value[0], type)
+                q = q & parser.query(lookup, value)
+                multi_join = multi_join or _is_multi_valued(self.ctype, lookup)
 
-        if self.base_query: q = q & self.base_query
+        if self.base_query:
+            q = q & self.base_query
+            multi_join = multi_join or any(_is_multi_valued(self.ctype, lookup)
+                    for lookup in _q_lookups(self.base_query))
 
         objs = self.ctype.objects.filter(q)
 
-        # Unfortunately, in order to AND together things like tags,
-        # we have to chain filters after the QuerySet.
-        #
-        # Q(tags=tag1) & Q(tags=tag2) does not work.
-        # self.ctype.objects.filter(tags=tag1).filter(tags=tag2)... does work
+        for parser, lookup, values in lists:
+            objs, joined = parser.filter(objs, lookup, values)
+            multi_join = multi_join or joined
 
-        if len(lists) > 0:
-            for list in lists:
-
-                # list is actually a dictionary. The key is the field
-                # name, the value is the actual list.
-                field = list.keys()[0]
-                for list_item in list[field]:
-
-                    # list is a list of strings
-                    objs = objs.filter(self.__get_query_obj(field,list_item,'string'))
-
-        if 'orderby' in special_params:
-            orderby = special_params['orderby']
-            desc = False
-            if orderby[0] == '-': 
-                orderby = orderby[1:]
-                desc = True
-            
-            if orderby in self.ruleset:
-                if 'alias' in self.ruleset[orderby]:
-                    orderby = self.ruleset[orderby]['alias']
-
-                if desc: orderby = '-' + orderby
-                objs = objs.order_by(orderby)
-            else:
-                raise InvalidParameterException('Invalid orderby field: ' + orderby)
+        if orderby:
+            ordering = compiled.order_by(orderby)
+            objs = objs.order_by(*ordering)
+            multi_join = multi_join or any(_is_multi_valued(self.ctype, o.lstrip('-')) for o in ordering)
+
+        if multi_join:
+            objs = objs.distinct()
+
+        stop_timer('translation')
 
-        objs = objs.distinct()
+        profile = get_profile()
+        if profile:
+            profile.add_queryset(self.ctype.__name__, objs)
+
+        if self.cache_group:
+            return self.__cached_ids(objs)
 
         return objs
 
-    def __get_query_obj(self, field, value, type):
+    def __cached_ids(self, objs):
         '''
-        Return a QuerySet object given a specific field and value
+        Returns the results of objs as a ResultIds, with the ids from the
+        cache if possible. Results of more than API_RESULT_CACHE_MAX_IDS
+        (10000) objects aren't cached, and objs is returned as is.
         '''
 
-        field, modifier = self.__get_field(field)
-
-        # Deal with alias
-        if 'alias' in self.ruleset[field]:
-            alias = self.ruleset[field]['alias']
-            new_field = field.replace(field, alias, 1)
-            field = new_field
-            
-        # Convert from unicode... need to add unicode support
-        field = str(field)
-        if len(modifier) != 0:
-            field = field + '__' + str(modifier)
-
-        # Deal with negation
-        if type == 'string':
-            if len(value) > 1 and value[0] == '~':
-                value = value[1:]
-                return ~Q(**{field:value})
+        try:
+            sql, params = objs.query.get_compiler(objs.db).as_sql()
+        except EmptyResultSet:
+            return objs
 
-        return Q(**{field:value})
+        key = 'results:' + hashlib.md5(stable_repr((objs.db, sql, params))).hexdigest()
+        ids = get_cache(key, self.cache_group)
 
-    def __get_field(self, field):
-        '''
-        Takes a field from the query string, and splits out the field name
-        and the modifier (i.e. author__contains returns author, contains)
-        '''
+        if ids is None:
+            max_ids = getattr(settings, 'API_RESULT_CACHE_MAX_IDS', 10000)
+            ids = list(objs.values_list('pk', flat = True)[:max_ids + 1])
 
-        modifier = ''
-        if field.find('__') != -1:
-            field, modifier = field.split('__', 1)
+            # Remember that it's too big, so the ids aren't fetched again
+            if len(ids) > max_ids:
+                ids = TOO_MANY_RESULTS
 
-        return field, modifier
+            set_cache(key, ids, self.cache_group,
+                    timeout = getattr(settings, 'API_RESULT_CACHE_TIMEOUT', 300))
 
-    def __sanitize(self, qdict): 
-        '''
-        Convert the values into python types, sanitize them using the rule set.
-        All values lists
-        '''
+        if ids == TOO_MANY_RESULTS:
+            return objs
 
-        for k, v in qdict.items():
+        return ResultIds(self.ctype.objects.all(), ids, self.request)
 
-            field, modifier = self.__get_field(k)
 
-            # If it's not a valid field, or a field that should be exposed, remove it
-            if not field in self.ruleset:
-                del qdict[k]
+class ResultIds(object):
+    '''
+    The results of a query, as an ordered list of ids (see QueryTranslator).
+    Works like a list of the objects for paginate, get_total and the
+    serializers: it has a length, and slicing it loads only the objects in
+    the slice, in order, with one lookup by primary key (in_bulk).
 
-            else:
-                # CHECK THE TYPE
-                type = self.ruleset[field]['type']
+    Arguments:
 
-                if type == 'string':
-                    qdict[k] = [str(v)]
+        queryset
+            The QuerySet to load objects from. Prepared for serialization
+            with api_prefetch.
 
-                elif type == 'int':
-                    qdict[k] = [int(v)]
+        ids
+            The list of primary keys of the results
 
-                elif type == 'bool':
-                    qdict[k] = [(v.lower() == 'true')]
+        request
+            The request being answered
+    '''
 
-                elif type == 'list':
-                    list = v.split(',')
-                    qdict[k] = list
+    chunk_size = 100
 
-                elif type == 'datetime':
-                    qdict[k] = [strtodate(v)]
+    def __init__(self, queryset, ids, request = None):
+        self.queryset = queryset
+        self.ids = ids
+        self.request = request
 
-                elif type=='geo_distance':
-                    # The value should be a tuple like this: (point, distance)
-                    # where point is a Point object and distance a Distance object
+    def __len__(self):
+        return len(self.ids)
 
-                    dist = v.split(',')
-                    pnt = Point(float(dist[0]), float(dist[1]))
-                    # TODO: make the measurement type specifiable i.e. 30mi, 20km
-                    #       right now it defaults to meters.
-                    dist = D(m=dist[2])
-                    qdict[k] = [(pnt, dist)]
+    def count(self):
+        return len(self.ids)
 
-                elif type=='geo_polygon':
-                    pnts = v.split(',')
-                    bbox = (float(pnts[0]), float(pnts[1]), 
-                            float(pnts[2]), float(pnts[3]))
-                    poly = Polygon.from_bbox(bbox)
-                    # TODO: 4326 - this should be a setting?
-                    poly.set_srid(4326)
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return self._load(self.ids[k])
 
-                    qdict[k] = [poly]
+        return self._load([self.ids[k]])[0]
 
-                else:
-                    qdict[k] = [str(v)]
+    def __iter__(self):
+        for start in range(0, len(self.ids), self.chunk_size):
+            for obj in self._load(self.ids[start:start + self.chunk_size]):
+                yield obj
 
-    def __extract_special_params(self, qdict, params):
-        '''
-        Takes any params specified in params and removes them from the
-        dict, and returns them as a separate dict
-        '''
-        special_params = {}
+    def _load(self, ids):
+        if not ids:
+            return []
 
-        for p in params:
-            if p in qdict:
-                if len(qdict[p]) > 0:
-                    special_params[p] = qdict[p]
-                del qdict[p]
+        objs = api_prefetch(self.queryset, self.request).in_bulk(ids)
 
-        return special_params
+        # Deleted since the ids were cached
+        return [objs[pk] for pk in ids if pk in objs]
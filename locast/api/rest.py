@@ -1,4 +1,5 @@
-from django.http import HttpResponse, HttpResponseNotAllowed
+from django.http import HttpResponseNotAllowed
+from django.http.response import HttpResponseBase
 
 # Allowed HTTP methods
 METHODS = sorted(('get','post','head','put','delete','options'))
@@ -46,9 +47,12 @@ class ResourceView(object):
             # A hackish way to deal with head requests
             if request_method == 'head' and hasattr(cls, 'get' + method):
                 response = getattr(cls, 'get' + method)(request, *args, **kwargs)
-                if not isinstance(response, HttpResponse): 
+                if not isinstance(response, HttpResponseBase): 
                     return ''
-                response.content = ''
+                if response.streaming:
+                    response.streaming_content = []
+                else:
+                    response.content = ''
                 return response
             else:
                 return cls.__not_allowed()
@@ -0,0 +1,12 @@
+from locast.api import APIResponseOK
+from locast.api.cache import get_stats
+from locast.api.exceptions import APIForbidden
+
+
+def cache_stats(request):
+    ''' Staff only view of the statistics of the API caches. '''
+
+    if not request.user.is_staff:
+        raise APIForbidden
+
+    return APIResponseOK(content=get_stats())
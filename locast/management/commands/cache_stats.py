@@ -0,0 +1,40 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from locast.api import codec
+from locast.api.cache import get_stats, reset_stats
+
+
+class Command(BaseCommand):
+    help = 'Shows the statistics of the API caches, per cache group.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--json', action='store_true', dest='json', default=False,
+            help='Output the raw statistics as json'),
+        make_option('--reset', action='store_true', dest='reset', default=False,
+            help='Clear the statistics after showing them'),
+    )
+
+    def handle(self, *args, **options):
+        stats = get_stats()
+
+        if options['json']:
+            self.stdout.write(codec.dumps(stats))
+
+        else:
+            self.stdout.write('%-30s %10s %10s %6s %10s %10s %12s %6s %8s %10s' % ('group', 'hits',
+                'misses', 'ratio', 'fills', 'avg fill', 'bytes', 'compr', 'invalid', 'coalesced'))
+
+            for cache_group, s in sorted(stats.items()):
+                lookups = s['hits'] + s['misses']
+                ratio = lookups and (float(s['hits']) / lookups) or 0
+                avg_fill = s['recomputed'] and (float(s['fill_ms']) / s['recomputed']) or 0
+                compression = s['bytes'] and (float(s['raw_bytes']) / s['bytes']) or 1
+
+                self.stdout.write('%-30s %10d %10d %5.1f%% %10d %8.1fms %12d %5.1fx %8d %10d' % (cache_group,
+                    s['hits'], s['misses'], ratio * 100, s['recomputed'], avg_fill, s['bytes'], compression,
+                    s['invalidations'], s['coalesced_wait'] + s['coalesced_stale']))
+
+        if options['reset']:
+            reset_stats()
@@ -0,0 +1,106 @@
+from optparse import make_option
+import Queue
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.test.client import Client
+
+from locast.api.cache import get_warm_samples, WARM_HEADER
+
+
+class Command(BaseCommand):
+    help = 'Requests the most requested API urls (see cache_api_response), so that their responses are cached.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', action='store', type='int', dest='limit', default=100,
+            help='The number of urls to request (default 100)'),
+        make_option('--concurrency', action='store', type='int', dest='concurrency', default=4,
+            help='The number of requests made at the same time (default 4)'),
+        make_option('--host', action='store', dest='host', default=None,
+            help='The Host header of the requests, if testserver is not allowed'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help='Show the urls and the expected cost, without requesting them'),
+    )
+
+    def handle(self, *args, **options):
+        samples = get_warm_samples(options['limit'])
+        if not samples:
+            self.stdout.write('No requests have been sampled.')
+            return
+
+        concurrency = max(1, options['concurrency'])
+
+        if options['dry_run']:
+            self.dry_run(samples, concurrency)
+        else:
+            self.warm(samples, concurrency, options['host'])
+
+    def dry_run(self, samples, concurrency):
+        self.stdout.write('%10s %10s  %s' % ('requests', 'avg fill', 'url'))
+
+        fill_ms = 0
+        unknown = 0
+        for sample in samples:
+            if sample['fill_ms'] is None:
+                unknown += 1
+                avg_fill = '?'
+            else:
+                fill_ms += sample['fill_ms']
+                avg_fill = '%.1fms' % sample['fill_ms']
+
+            self.stdout.write('%10d %10s  %s' % (sample['requests'], avg_fill, self.label(sample)))
+
+        self.stdout.write('%d urls, %.1fs of computation (%d unknown), about %.1fs with a concurrency of %d' %
+                (len(samples), fill_ms / 1000, unknown, fill_ms / 1000 / concurrency, concurrency))
+
+    def warm(self, samples, concurrency, host):
+        queue = Queue.Queue()
+        for sample in samples:
+            queue.put(sample)
+
+        headers = {WARM_HEADER: '1'}
+        if host:
+            headers['HTTP_HOST'] = host
+
+        results = []
+
+        def _worker():
+            client = Client()
+            while True:
+                try:
+                    sample = queue.get_nowait()
+                except Queue.Empty:
+                    return
+
+                extra = dict(headers)
+                if sample['language']:
+                    extra['HTTP_ACCEPT_LANGUAGE'] = sample['language']
+
+                started = time.time()
+                try:
+                    status = client.get(sample['url'], **extra).status_code
+                except Exception, e:
+                    status = 'error: %s' % e
+
+                results.append((sample, status, (time.time() - started) * 1000))
+
+        started = time.time()
+        threads = [threading.Thread(target = _worker) for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        failed = 0
+        for sample, status, ms in results:
+            if status != 200:
+                failed += 1
+            self.stdout.write('%10s %8.1fms  %s' % (status, ms, self.label(sample)))
+
+        self.stdout.write('%d urls requested in %.1fs, %d failed' % (len(results), time.time() - started, failed))
+
+    def label(self, sample):
+        if sample['language']:
+            return '%s (%s)' % (sample['url'], sample['language'])
+        return sample['url']
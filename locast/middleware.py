@@ -7,6 +7,7 @@ from django.core.exceptions import PermissionDenied
 from django.shortcuts import render_to_response
 from django.template import RequestContext
 
+from locast.api.cache import finish_coalescing, flush_coalescing, start_coalescing
 from locast.api.exceptions import APIBadRequest, APIUnauthorized, APIForbidden, APINotFound, APIConflict
 from locast.auth.exceptions import HttpAuthenticationError
 
@@ -150,3 +151,28 @@ class CORSMiddleware(object):
         response['Access-Control-Allow-Origin']  = self.CORS_ALLOWED_ORIGINS 
 
         return response
+
+
+class CacheInvalidationMiddleware(object):
+    '''
+    Coalesces the cache group invalidations made during a request (see
+    locast.api.cache.register_cache_group), so each group is invalidated
+    once, when the response is ready.
+    '''
+
+    def process_request(self, request):
+        # The process_response of an earlier request on this thread may not
+        # have run (i.e. if a later middleware raised). Its invalidations
+        # are applied here, instead of being collected forever.
+        flush_coalescing()
+
+        start_coalescing()
+        request._locast_coalescing = True
+
+    def process_response(self, request, response):
+        # Another middleware may have returned before process_request ran
+        if getattr(request, '_locast_coalescing', False):
+            request._locast_coalescing = False
+            finish_coalescing()
+
+        return response
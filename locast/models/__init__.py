@@ -1,5 +1,7 @@
 from django.db import models
 
+from locast.api.cache import get_changed_fields, invalidate_instance
+
 # ALL base models should use this, but not interfaces though.
 # A base model is something that could be used as a standalone model. An interface is something that would alter a basemodel.
 
@@ -23,13 +25,27 @@ class ModelBase(models.Model):
         '''
         Overrides default save behavior to call _pre_save and _post_save from 
         any interfaces that this model inherits from, as well as pre_save
-        and post_save on the model itself.
+        and post_save on the model itself. Invalidates any cache groups 
+        registered for the model (see locast.api.cache.register_cache_group)
         '''
 
+        adding = self._state.adding
+
         self._super_pre_save()
         models.Model.save(self, *args, **kargs)
         self._super_post_save()
 
+        invalidate_instance(self, None if adding else get_changed_fields(self))
+
+    def delete(self, *args, **kargs):
+        '''
+        Overrides default delete behavior to invalidate any cache groups
+        registered for the model.
+        '''
+
+        models.Model.delete(self, *args, **kargs)
+        invalidate_instance(self)
+
     def _super_pre_save(self):
         '''
         Calls every _pre_save on any parent class (interface), calls pre_save
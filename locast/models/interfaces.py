@@ -6,12 +6,12 @@ from django.contrib.contenttypes import generic
 from django.contrib.gis.db import models as gismodels
 from django.contrib.gis.geos import Point
 from django.db import models
-from django.db.models import Q
+from django.db.models import Count, Q
 from django.utils.translation import ugettext_lazy as _
 from django.utils import timezone
 
 from locast import get_model
-from locast.api import datetostr, api_serialize
+from locast.api import datetostr, api_serialize, is_deferred
 
 
 class Syncable(models.Model):
@@ -28,6 +28,8 @@ class Syncable(models.Model):
 
     modified = models.DateTimeField('date modified', default = timezone.now, editable = False)
 
+    _api_keys = ('created', 'modified', 'uuid')
+
     def _api_serialize(self, request):
         d = {}
 
@@ -44,6 +46,9 @@ class Syncable(models.Model):
         if not self.uuid:
             self.uuid = self._generate_uuid()
 
+        # Also what invalidates cached serializations, see api_serialize
+        self.modified = timezone.now()
+
 
 class Authorable(Syncable):
     ''' 
@@ -53,18 +58,34 @@ class Authorable(Syncable):
     class Meta:
         abstract = True
 
+    _api_keys = Syncable._api_keys + ('author', 'is_author', 'allowed_edit')
+
     def _api_serialize(self, request):
         d = Syncable._api_serialize(self, request)
 
         author = api_serialize(self.author)
         d['author'] = author
 
+        d.update(Authorable._api_serialize_volatile(self, request))
+
+        return d
+
+    def _api_serialize_volatile(self, request):
+        ''' See: locast.api.api_serialize '''
+
+        d = {}
         if request:
             d['is_author'] = self.is_author(request.user)
             d['allowed_edit'] = self.allowed_edit(request.user)
 
         return d
 
+    @staticmethod
+    def _api_prefetch(queryset, request):
+        ''' See: locast.api.api_serialize_many '''
+
+        return queryset.select_related('author')
+
     author = models.ForeignKey(settings.AUTH_USER_MODEL)
 
     def is_author(self, user):
@@ -82,10 +103,6 @@ class Authorable(Syncable):
 
         return user.is_authenticated()
 
-    def _pre_save(self):
-       Syncable._pre_save(self)
-       self.modified = timezone.now()
-    
 
 class PrivatelyAuthorable(Authorable):
     ''' 
@@ -116,6 +133,8 @@ class PrivatelyAuthorable(Authorable):
     class Meta:
         abstract = True
 
+    _api_keys = Authorable._api_keys + ('privacy',)
+
     def _api_serialize(self, request):
         d = Authorable._api_serialize(self, request)
 
@@ -204,10 +223,14 @@ class Titled(models.Model):
     class Meta:
         abstract = True
 
+    _api_keys = ('title', 'description')
+
+    _api_deferrable = {'description': 'description'}
+
     def _api_serialize(self, request):
         d = {}
         d['title'] = self.title
-        if self.description:
+        if not is_deferred(self, 'description') and self.description:
             d['description'] = self.description
 
         return d
@@ -223,6 +246,8 @@ class Locatable(models.Model):
     class Meta:
         abstract = True
 
+    _api_keys = ('location',)
+
     def _api_serialize(self, request):
         d = {} 
         if self.location:
@@ -300,15 +325,61 @@ class Favoritable(models.Model):
     class Meta:
         abstract = True
 
+    _api_keys = ('favorite', 'favorite_count')
+
     def _api_serialize(self, request):
+        return Favoritable._api_serialize_volatile(self, request)
+
+    def _api_serialize_volatile(self, request):
+        ''' See: locast.api.api_serialize '''
+
         d = {}
         if request:
-            d['favorite'] = self.is_favorited_by(request.user)
-
-        d['favorite_count'] = self.favorited_by.count()
+            # Set by _api_prefetch_objects
+            if hasattr(self, '_api_favorited'):
+                d['favorite'] = self._api_favorited
+            else:
+                d['favorite'] = self.is_favorited_by(request.user)
+
+        if hasattr(self, '_api_favorite_count'):
+            d['favorite_count'] = self._api_favorite_count
+        else:
+            d['favorite_count'] = self.favorited_by.count()
 
         return d
 
+    @staticmethod
+    def _api_prefetch_objects(objs, request):
+        '''
+        See: locast.api.api_serialize_many
+
+        Counts the favorites of all of the objects in one query, and finds
+        the ones favorited by the requesting user in another.
+        '''
+
+        if not objs:
+            return
+
+        field = objs[0]._meta.get_field('favorited_by')
+        through = field.rel.through
+        source = field.m2m_field_name()
+        target = field.m2m_reverse_field_name()
+
+        ids = [o.pk for o in objs]
+
+        counts = dict(through.objects.filter(**{source + '__in': ids})
+                .values_list(source).annotate(Count('pk')))
+
+        favorited = set()
+        if request and request.user.is_authenticated():
+            favorited = set(through.objects.filter(**{source + '__in': ids, target: request.user.pk})
+                    .values_list(source, flat=True))
+
+        for o in objs:
+            o._api_favorite_count = counts.get(o.pk, 0)
+            if request:
+                o._api_favorited = (o.pk in favorited)
+
     favorited_by = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name='favorite_%(class)s', null=True, blank=True)
 
     def favorite(self, user): 
@@ -341,12 +412,34 @@ class Taggable(models.Model):
     class Meta:
         abstract = True
 
+    _api_keys = ('tags', 'system_tags')
+
     def _api_serialize(self, request):
+       return Taggable._api_serialize_volatile(self, request)
+
+    def _api_serialize_volatile(self, request):
+       ''' See: locast.api.api_serialize '''
+
        d = {}
-       d['tags'] = map(lambda t: t.name, self.tags.filter(system_tag=False))
-       d['system_tags'] = map(lambda t: t.name, self.tags.filter(system_tag=True))
+
+       # If the tags were loaded by _api_prefetch, split them up here rather
+       # than running two more queries.
+       if 'tags' in getattr(self, '_prefetched_objects_cache', {}):
+           tags = self.tags.all()
+           d['tags'] = [t.name for t in tags if not t.system_tag]
+           d['system_tags'] = [t.name for t in tags if t.system_tag]
+       else:
+           d['tags'] = map(lambda t: t.name, self.tags.filter(system_tag=False))
+           d['system_tags'] = map(lambda t: t.name, self.tags.filter(system_tag=True))
+
        return d
 
+    @staticmethod
+    def _api_prefetch(queryset, request):
+        ''' See: locast.api.api_serialize_many '''
+
+        return queryset.prefetch_related('tags')
+
     tags = models.ManyToManyField('tag', related_name='tag_%(class)s', null=True, blank=True)
 
     # Sets all non-system tags based on a list of tags (string or python list)
@@ -8,6 +8,7 @@ from django.contrib.gis.db.models.manager import GeoManager
 from django.db import models
 
 from locast import get_model
+from locast.api.cache import coalesce_invalidation
 from locast.auth.exceptions import PairingException
 from locast.util import random_string
 
@@ -147,12 +148,15 @@ class UserActivityManager(models.Manager):
             raise Exception('Invalid Action')
 
         if user.is_authenticated():
-            ua = get_model('useractivity')()
-            ua.user = user
-            ua.action = action
-            ua.content_object = object
-            ua.save()
-            user_activity_signal.send(sender=ua, action=ua.action)
+            # Anything invalidated by the activity or its receivers is
+            # invalidated once
+            with coalesce_invalidation():
+                ua = get_model('useractivity')()
+                ua.user = user
+                ua.action = action
+                ua.content_object = object
+                ua.save()
+                user_activity_signal.send(sender=ua, action=ua.action)
 
     def get_activities_by_model(self, model):
         ''' Returns all activities relating to a certain model. '''
@@ -18,7 +18,7 @@ from django.utils.translation import ugettext_lazy as _
 from django.utils import timezone
 
 from locast import get_model
-from locast.api import api_serialize
+from locast.api import api_serialize, is_deferred
 from locast.models import ModelBase
 from locast.models.interfaces import Authorable, Locatable, Titled
 from locast.models.managers import BoundaryManager, CommentManager, LocastUserManager, RouteManager, UserActivityManager
@@ -514,6 +514,8 @@ class LocastUser(ModelBase, AbstractUser):
     def get_absolute_url(self):
         return None
 
+    _api_keys = ('display_name',)
+
     def _api_serialize(self, request=None):
         d = {}
         if self.display_name:
@@ -585,10 +587,15 @@ class Comment(ModelBase, Authorable):
     def __unicode__(self):
         return unicode(self.body) + ' (id: ' + unicode(self.id) + ')'
 
+    _api_keys = Authorable._api_keys + ('content',)
+
+    _api_deferrable = {'content': 'body'}
+
     def _api_serialize(self, request):
         d = Authorable._api_serialize(self, request)
         d['author'] = api_serialize(self.author)
-        d['content'] = self.body
+        if not is_deferred(self, 'body'):
+            d['content'] = self.body
 
         return d
 
@@ -684,6 +691,10 @@ class MapPlace(ModelBase, Locatable, Titled):
     def __unicode__(self):
         return u'%s' % self.title
 
+    _api_keys = Locatable._api_keys + Titled._api_keys + ('zoom_level',)
+
+    _api_deferrable = Titled._api_deferrable
+
     def _api_serialize(self, request=None):
         d = Locatable._api_serialize(self, request)
         d.update(Titled._api_serialize(self, request))